@@ -1,51 +1,20 @@
 import os
 import json
-from pprint import pprint
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+import threading
+from contextlib import nullcontext
+from transformers import AutoTokenizer, AutoModelForCausalLM
 import json5
 from json_repair import repair_json
 
+from calls import BatchGenerator, PrefixCachedPipeline
+from pipeline import Pipeline, Stage
+from fuzzy_align import (align_span, number_sentences, parse_span, slice_span,
+                         verify_decision, verify_span)
 
-def read_lines(filepath, encoding="utf-8"):
-    """
-    Reads all non-empty lines from a text file and returns them as a clean list.
-    Empty or whitespace-only lines are skipped.
-    """
-    lines = []
-    with open(filepath, "r", encoding=encoding) as f:
-        for line in f:
-            clean = line.strip()
-            if clean:  # keep only non-empty lines
-                lines.append(clean)
-    return lines
-
-
-def get_reference(i):
-    offset = 50
-    x = len(lines) * i / 77
-    print(x)
-    indx = int(x)
-    s, e = max(0, indx - offset), indx + offset
-    print(s, e)
-    return "\n".join(lines[s : e + 1])
-
-
-def find_text():
-    for i, l in enumerate(lines):
-        if "receiver back down and stroked" in l:
-            print(i)
-            print(l)
-
-
-def read_json(filepath, encoding="utf-8"):
-    with open(filepath, "r", encoding=encoding) as f:
-        data = json.load(f)
-    return data
-
+# Below this align_span confidence, a chunk is aligned by the LLM instead
+FUZZY_MIN_CONFIDENCE = 0.8
 
-def align_chunk(chunk_indx, source_text, tokenizer, pipe):
-    reference = get_reference(chunk_indx)
-    sys_prompt = """You are an expert at textual alignment. 
+ALIGN_SYS_PROMPT = """You are an expert at textual alignment. 
 You are given a piece of text as source, and a reference paragraph, your task is to find and select the target text from the reference paragraph that matches the source.
 Note that the source and the target may vary slightly, but overall almost identical. You MUST NOT invent new texts, you just need to find the matching target text from the reference paragraph, and faithfully copy & paste it as the target. You MUST NOT over-select or under-select target text from the reference paragraph. 
 You MUST NOT add redundant words to your target output, just the matching text your found in the reference, nothing more, nothing less. 
@@ -76,42 +45,37 @@ Output:
     "target": "He put the receiver back down and stroked his mustache, thinking."
 }
 """
-    user_prompt = f"""Here is the source and reference texts, give your thinking process and find the target:
+
+# Span output: the model names the first and last sentence of the target
+# in a numbered reference, and the text is sliced out locally
+ALIGN_SPAN_SYS_PROMPT = """You are an expert at textual alignment.
+You are given a piece of text as source, and a reference whose sentences are numbered [1], [2], ...; your task is to find the sentences of the reference that match the source.
+Note that the source and the target may vary slightly in spelling and punctuation, but overall almost identical. The beginning and the end of the target must closely match the beginning and the end of the source respectively.
+Output ONLY the numbers of the first and the last matching sentence in json format, nothing else.
+
+## example
 Input:
-{{
-    "source": "{source_text}",
-    "reference": "{reference}"
-}}
+{
+    "source": "\"'Mr. and Mrs. Dursley, of No. 4 Privet Drive, \"'were proud to say that they were perfectly normal, thank you very much. They were the last people you'd expect to be involved in anything strange or mysterious, because they just didn't hold with such nonsense.",
+    "reference": "[1] Mr. and Mrs. Dursley, of number four, Privet Drive, were proud to say that they were perfectly normal, thank you very much.\n[2] They were the last people you’d expect to be involved in anything strange or mysterious, because they just didn’t hold with such nonsense.\n[3] Mr. Dursley was the director of a firm called Grunnings, which made drills.\n[4] He was a big, beefy man with hardly any neck, although he did have a very large mustache."
+}
 Output:
-"""
-    messages = [
-        {"role": "system", "content": sys_prompt},
-        {"role": "user", "content": user_prompt},
-    ]
-    # print(user_prompt)
-    # Apply chat template
-    prompt = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True,
-        enable_thinking=False,
-    )
+{"start": 1, "end": 2}
 
-    # Run inference
-    output = pipe(
-        prompt,
-        temperature=0.1,
-        top_p=0.8,
-        max_new_tokens=2048,
-        return_full_text=False,
-    )[0]["generated_text"]
-    output = repair_json(output)
-    output = json5.loads(output)
-    return output
+## example
+Input:
+{
+    "source": "He dashed back across the road, hurried up to his office, snapped at his secretary not to disturb him, seized his telephone and had almost finished dialling his home number when he changed his mind. He put the receiver back down and stroked his moustache, thinking.",
+    "reference": "[1] Mr. Dursley stopped dead.\n[2] Fear flooded him.\n[3] He looked back at the whisperers as if he wanted to say something to them, but thought better of it.\n[4] He dashed back across the road, hurried up to his office, snapped at his secretary not to disturb him, seized his telephone, and had almost finished dialing his home number when he changed his mind.\n[5] He put the receiver back down and stroked his mustache, thinking…\n[6] no, he was being stupid.\n[7] Potter wasn’t such an unusual name."
+}
+Output:
+{"start": 4, "end": 5}
+"""
 
+# The span answer is about ten tokens; generation stops at its "}"
+SPAN_MAX_NEW_TOKENS = 32
 
-def verify_alignment(res_json, tokenizer, pipe):
-    sys_prompt = """You are an expert at textual alignment. 
+VERIFY_SYS_PROMPT = """You are an expert at textual alignment. 
 You are given a piece of json text, compare the source and target texts, and judge if the two are aligned. And output a boolean judgement, along with your thinking process (no more than 100 tokens) in a json format.
 
 It is ok for the two to have different spelling/punctuation here and there.
@@ -184,16 +148,186 @@ Output:
 
 
 """
-    user_prompt = f"""Here is input json data, give your thinking process and decision in strictly json format in the output:
+
+
+def read_lines(filepath, encoding="utf-8"):
+    """
+    Reads all non-empty lines from a text file and returns them as a clean list.
+    Empty or whitespace-only lines are skipped.
+    """
+    lines = []
+    with open(filepath, "r", encoding=encoding) as f:
+        for line in f:
+            clean = line.strip()
+            if clean:  # keep only non-empty lines
+                lines.append(clean)
+    return lines
+
+
+class AlignmentSession:
+    """
+    Aligns the chunks of one chapter, in order, against the chapter text.
+
+    A cursor marks the end of the previous chunk's target. Each chunk's
+    reference window starts just before the cursor and is sized from the
+    chunk's own source text, so the prompt grows with the chunk rather
+    than the chapter. When no match is found, the next attempt uses a
+    window retry_scale times wider, and only then is the cursor left alone.
+    """
+
+    def __init__(self, reference_file, window_scale=1.5, slack_chars=300,
+                 retry_scale=4, max_attempts=3):
+        self.text = "\n".join(read_lines(reference_file))
+        self.cursor = 0
+        self.window_scale = window_scale
+        self.slack_chars = slack_chars
+        self.retry_scale = retry_scale
+        self.max_attempts = max_attempts
+
+    def window(self, source_text, attempt=0):
+        """Return (reference, offset) for a source text: the window of the
+        chapter text to search and where it starts in the chapter."""
+        grow = self.retry_scale ** attempt
+        lo = max(0, self.cursor - self.slack_chars * grow)
+        hi = self.cursor + int(
+            (len(source_text) * self.window_scale + self.slack_chars) * grow)
+        # Widen to whole words
+        while lo > 0 and not self.text[lo - 1].isspace():
+            lo -= 1
+        while hi < len(self.text) and not self.text[hi].isspace():
+            hi += 1
+        return self.text[lo:hi], lo
+
+    def locate(self, target, reference, offset):
+        """Chapter (start, end) of a target found in a window, or None."""
+        if not target:
+            return None
+        i = reference.find(target)
+        if i >= 0:
+            return offset + i, offset + i + len(target)
+        match = align_span(target, reference)
+        if match["score"] < FUZZY_MIN_CONFIDENCE:
+            return None
+        return offset + match["start"], offset + match["end"]
+
+    def advance(self, target):
+        """Move the cursor past a target aligned earlier, e.g. read from an
+        existing _aligned.json. Returns False if it cannot be found."""
+        for attempt in range(self.max_attempts):
+            reference, offset = self.window(target, attempt)
+            span = self.locate(target, reference, offset)
+            if span is not None:
+                self.cursor = span[1]
+                return True
+        return False
+
+    def match(self, source_text):
+        """
+        Align the next chunk with the fuzzy aligner alone, in growing
+        windows. Returns None, leaving the cursor, if it is not confident.
+        """
+        for attempt in range(self.max_attempts):
+            reference, offset = self.window(source_text, attempt)
+            fuzzy = align_span(source_text, reference)
+            if fuzzy["score"] >= FUZZY_MIN_CONFIDENCE:
+                self.cursor = offset + fuzzy["end"]
+                return {
+                    "think": f"fuzzy match, confidence {fuzzy['score']:.2f}",
+                    "target": fuzzy["target"],
+                }
+        return None
+
+    def align(self, source_text, tokenizer, pipe):
+        """
+        Align the next chunk: align_chunk in a window at the cursor,
+        retried in wider windows while the target is not in the window.
+        """
+        for attempt in range(self.max_attempts):
+            reference, offset = self.window(source_text, attempt)
+            print(f"Reference window: {offset}-{offset + len(reference)} "
+                  f"({len(reference)} chars, attempt {attempt + 1})")
+            output = align_chunk(reference, source_text, tokenizer, pipe)
+            span = self.locate(output.get("target", ""), reference, offset)
+            if span is not None:
+                self.cursor = span[1]
+                return output
+        return output
+
+
+def find_text(lines, snippet):
+    for i, l in enumerate(lines):
+        if snippet in l:
+            print(i)
+            print(l)
+
+
+def read_json(filepath, encoding="utf-8"):
+    with open(filepath, "r", encoding=encoding) as f:
+        data = json.load(f)
+    return data
+
+
+def align_chunk(reference, source_text, tokenizer, pipe,
+                min_confidence=FUZZY_MIN_CONFIDENCE, span_output=True):
+    """
+    Find the target text of a chunk in its reference window (see
+    AlignmentSession). The deterministic fuzzy aligner is tried first; the
+    LLM is only asked when its confidence is below min_confidence.
+
+    With span_output, the LLM only names the first and last sentence of
+    the numbered reference and the target is sliced from the reference,
+    so it is always verbatim; otherwise it copies the target out as JSON.
+    """
+    fuzzy = align_span(source_text, reference)
+    if fuzzy["score"] >= min_confidence:
+        return {
+            "think": f"fuzzy match, confidence {fuzzy['score']:.2f}",
+            "target": fuzzy["target"],
+        }
+
+    if span_output:
+        prompt, spans = build_span_prompt(reference, source_text, tokenizer)
+        output = pipe(
+            prompt,
+            temperature=0.1,
+            top_p=0.8,
+            max_new_tokens=SPAN_MAX_NEW_TOKENS,
+            stop_strings=["}"],
+            return_full_text=False,
+        )[0]["generated_text"]
+        start, end = parse_span(output)
+        return {
+            "think": f"sentences {start}-{end}",
+            "target": slice_span(reference, spans, start, end),
+        }
+
+    prompt = build_align_prompt(reference, source_text, tokenizer)
+
+    # Run inference
+    output = pipe(
+        prompt,
+        temperature=0.1,
+        top_p=0.8,
+        max_new_tokens=2048,
+        return_full_text=False,
+    )[0]["generated_text"]
+    return parse_align_output(output)
+
+
+def build_align_prompt(reference, source_text, tokenizer):
+    user_prompt = f"""Here is the source and reference texts, give your thinking process and find the target:
 Input:
-{res_json}
+{{
+    "source": "{source_text}",
+    "reference": "{reference}"
+}}
 Output:
-
 """
     messages = [
-        {"role": "system", "content": sys_prompt},
+        {"role": "system", "content": ALIGN_SYS_PROMPT},
         {"role": "user", "content": user_prompt},
     ]
+    # print(user_prompt)
     # Apply chat template
     prompt = tokenizer.apply_chat_template(
         messages,
@@ -201,6 +335,40 @@ Output:
         add_generation_prompt=True,
         enable_thinking=False,
     )
+    return prompt
+
+
+def build_span_prompt(reference, source_text, tokenizer):
+    """Return (prompt, spans) for span output; see number_sentences."""
+    numbered, spans = number_sentences(reference)
+    user_prompt = f"""Here is the source and the numbered reference, give the first and last matching sentence:
+Input:
+{{
+    "source": "{source_text}",
+    "reference": "{numbered}"
+}}
+Output:
+"""
+    messages = [
+        {"role": "system", "content": ALIGN_SPAN_SYS_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+    prompt = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    return prompt, spans
+
+
+def parse_align_output(output):
+    output = repair_json(output)
+    return json5.loads(output)
+
+
+def verify_alignment(res_json, tokenizer, pipe):
+    prompt = build_verify_prompt(res_json, tokenizer)
 
     # Run inference
     output = pipe(
@@ -215,49 +383,238 @@ Output:
     return output
 
 
-if __name__ == "__main__":
+def verify_chunk(res, tokenizer, pipe, model_lock=None):
+    """
+    Judge an alignment with the deterministic verify_span; only a score in
+    its uncertain band is passed on to verify_alignment (the LLM judge),
+    holding model_lock if given.
+    """
+    check = verify_span(res["source"], res["target"])
+    decision = verify_decision(check["score"])
+    if decision is None:
+        res_json = json.dumps(res, ensure_ascii=False, indent=2)
+        with model_lock or nullcontext():
+            return verify_alignment(res_json, tokenizer, pipe)
+    return {"think": check["reason"], "decision": str(decision)}
+
 
-    lines = read_lines(
-        "/home/bo/workspace/transcribe_and_align/data/HP1/text_en/1/ch1.txt"
+def build_verify_prompt(res_json, tokenizer):
+    user_prompt = f"""Here is input json data, give your thinking process and decision in strictly json format in the output:
+Input:
+{res_json}
+Output:
+
+"""
+    messages = [
+        {"role": "system", "content": VERIFY_SYS_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+    # Apply chat template
+    prompt = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    return prompt
+
+
+def chunk_number(filename):
+    return int(filename.split("_")[1].split(".")[0])
+
+
+def save_aligned(folder, res):
+    output_file = os.path.join(
+        folder, res["chunk_file"].replace(".wav", "_aligned.json")
     )
-    model_name = "Qwen/Qwen3-8B"
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(res, f, ensure_ascii=False, indent=2)
+
+
+def align_pipeline(session, folder, tokenizer, pipe, queue_size=4):
+    """
+    The per-chunk steps as a Pipeline of stages, so they overlap: while
+    one chunk is aligned, the previous one is verified and the next ones
+    are read and located. Feed it chunk file names in order.
+
+        load    read the chunk (or its existing _aligned.json)
+        locate  fuzzy match at the session cursor, or the reference
+                windows the LLM should search (see AlignmentSession)
+        align   LLM alignment in those windows, widest last
+        verify  verify_chunk
+        persist save_aligned
+
+    align and verify share the model, so their model calls (align_chunk
+    and the verify_alignment fallback) take turns on one lock; verify's
+    deterministic check runs while a chunk is being aligned. Only locate
+    moves the cursor, so it runs one chunk at a time and in order; a
+    chunk left to the LLM leaves the cursor where it was, like the
+    batched path of align_chunks.
+    """
+    model_lock = threading.Lock()
+
+    def load(f):
+        p = os.path.join(folder, f)
+        p_aligned = p.replace(".json", "_aligned.json")
+        if os.path.exists(p_aligned):
+            return {"done": read_json(p_aligned)}
+        data = read_json(p)
+        return {"chunk_file": data["chunk_file"], "source": data["text"]}
+
+    def locate(res):
+        if "done" in res:
+            session.advance(res["done"]["target"])
+            return None
+        a_output = session.match(res["source"])
+        if a_output is not None:
+            return dict(res, target=a_output["target"])
+        res["windows"] = [session.window(res["source"], attempt)[0]
+                          for attempt in range(1, session.max_attempts)]
+        return res
+
+    def align(res):
+        if "target" in res:
+            return res
+        windows = res.pop("windows")
+        for reference in windows:
+            try:
+                with model_lock:
+                    a_output = align_chunk(reference, res["source"],
+                                           tokenizer, pipe)
+            except ValueError as e:
+                print(f"Error aligning {res['chunk_file']}: {e}")
+                continue
+            if a_output.get("target"):
+                return dict(res, target=a_output["target"])
+        return None
+
+    def verify(res):
+        b_output = verify_chunk(res, tokenizer, pipe, model_lock)
+        if str(b_output.get("decision", "")).lower() != "true":
+            print(f"Rejected {res['chunk_file']}: {b_output.get('think')}")
+            return None
+        return res
+
+    def persist(res):
+        save_aligned(folder, res)
+        print(f"Aligned {res['chunk_file']}")
+        return res
+
+    stages = [Stage(fn.__name__, fn) for fn in
+              (load, locate, align, verify, persist)]
+    return Pipeline(stages, queue_size=queue_size)
+
+
+def align_chunks(reference_file, folder, model_name="Qwen/Qwen3-8B",
+                 batched=True, memory_budget_gb=8.0):
+    """
+    Align every chunk transcript in folder that has no _aligned.json yet
+    to the English chapter text, and keep the ones the verifier accepts.
+
+    With batched=True, the chunks are first matched in order by the fuzzy
+    aligner; the ones it is unsure of are then aligned by the LLM all
+    together, and the alignments verify_span is unsure of are verified
+    together, by a BatchGenerator sized to memory_budget_gb. Outputs that
+    do not parse only drop their own chunk. Otherwise the chunks stream
+    through align_pipeline, one at a time per stage.
+    """
+    session = AlignmentSession(reference_file)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForCausalLM.from_pretrained(
         model_name, torch_dtype="auto", device_map="auto"
     )
-    pipe = pipeline("text-generation", model=model, tokenizer=tokenizer)
 
-    folder = "/home/bo/workspace/transcribe_and_align/data/HP1/audio_en/ch1_chunks"
-    files = [
-        f for f in sorted(os.listdir(folder)) if ".json" in f and "aligned" not in f
-    ]
+    # In chunk order, so the session cursor moves forward through the chapter
+    files = sorted(
+        (f for f in os.listdir(folder)
+         if f.startswith("chunk_") and f.endswith(".json")
+         and "aligned" not in f and "error" not in f and "words" not in f),
+        key=chunk_number,
+    )
+
+    if not batched:
+        # The system prompts are prefilled once and reused by every chunk
+        pipe = PrefixCachedPipeline(
+            model, tokenizer, [ALIGN_SPAN_SYS_PROMPT, VERIFY_SYS_PROMPT]
+        )
+        align_pipeline(session, folder, tokenizer, pipe).run(files)
+        return
+
+    batcher = BatchGenerator(model, tokenizer,
+                             memory_budget_gb=memory_budget_gb)
+    sampling = {"do_sample": True, "temperature": 0.1, "top_p": 0.8}
+
+    # 1. fuzzy matches in chunk order; unsure chunks get a wide window
+    aligned, pending = [], []
     for f in files:
         p = os.path.join(folder, f)
         p_aligned = p.replace(".json", "_aligned.json")
-        if not os.path.exists(p_aligned):
-            print(f)
-            data = read_json(p)
-            source = data["text"]
-            chunk_file = data["chunk_file"]
-            indx = int(f.replace(".json", "").replace("chunk_", ""))
-            a_output = align_chunk(indx, source, tokenizer, pipe)
-            pprint(a_output)
-            res = {
-                "chunk_file": chunk_file,
-                "source": source,
-                "target": a_output["target"],
-            }
-            pprint(res)
-            res_json = json.dumps(res, ensure_ascii=False, indent=2)
-            b_output = verify_alignment(res_json, tokenizer, pipe)
-            pprint(b_output)
-            if b_output["decision"].lower() == "true":
-                output_file = os.path.join(
-                    folder, chunk_file.replace(".wav", "_aligned.json")
-                )
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(res, f, ensure_ascii=False, indent=2)
-
-            print(
-                "======================================================================"
-            )
+        if os.path.exists(p_aligned):
+            session.advance(read_json(p_aligned)["target"])
+            continue
+        data = read_json(p)
+        res = {"chunk_file": data["chunk_file"], "source": data["text"]}
+        a_output = session.match(data["text"])
+        if a_output is not None:
+            aligned.append(dict(res, target=a_output["target"]))
+        else:
+            reference, _ = session.window(data["text"], attempt=1)
+            pending.append((res, reference))
+    print(f"{len(aligned)} chunks matched by the fuzzy aligner, "
+          f"{len(pending)} left for the LLM")
+
+    # 2. LLM alignment of the rest, in batches, as sentence spans
+    if pending:
+        prompts, spans = zip(*(
+            build_span_prompt(reference, res["source"], tokenizer)
+            for res, reference in pending
+        ))
+        outputs = batcher.run(list(prompts), parse_span,
+                              max_new_tokens=SPAN_MAX_NEW_TOKENS,
+                              stop_strings=["}"], **sampling)
+        for (res, reference), sent_spans, (span, error) in zip(
+                pending, spans, outputs):
+            if error is None:
+                try:
+                    target = slice_span(reference, sent_spans, *span)
+                except ValueError as e:
+                    error = e
+            if error is not None:
+                print(f"Error aligning {res['chunk_file']}: {error}")
+                continue
+            aligned.append(dict(res, target=target))
+
+    # 3. verification: deterministic, then the LLM for the uncertain band
+    uncertain = []
+    for res in aligned:
+        check = verify_span(res["source"], res["target"])
+        decision = verify_decision(check["score"])
+        if decision is None:
+            uncertain.append(res)
+        elif decision:
+            save_aligned(folder, res)
+        else:
+            print(f"Rejected {res['chunk_file']}: {check['reason']}")
+    print(f"{len(aligned) - len(uncertain)} chunks verified without the "
+          f"LLM, {len(uncertain)} left for it")
+
+    prompts = [
+        build_verify_prompt(json.dumps(res, ensure_ascii=False, indent=2),
+                            tokenizer)
+        for res in uncertain
+    ]
+    outputs = batcher.run(prompts, json5.loads, max_new_tokens=1024,
+                          **sampling)
+    for res, (b_output, error) in zip(uncertain, outputs):
+        if error is not None:
+            print(f"Error verifying {res['chunk_file']}: {error}")
+        elif str(b_output.get("decision", "")).lower() == "true":
+            save_aligned(folder, res)
+
+
+if __name__ == "__main__":
+    align_chunks(
+        "/home/bo/workspace/transcribe_and_align/data/HP1/text_en/1/ch1.txt",
+        "/home/bo/workspace/transcribe_and_align/data/HP1/audio_en/ch1_chunks",
+        model_name="Qwen/Qwen3-8B",
+    )
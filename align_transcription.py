@@ -1,11 +1,21 @@
+import bisect
+import itertools
 import json
+import os
 import re
+import time
+from collections import Counter
 from pathlib import Path
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from transformers import AutoTokenizer, AutoModelForCausalLM
 from tqdm import tqdm
 
+from bilingual_align import MIN_CONFIDENCE, align_chunks_zh
+from calls import BatchGenerator, PrefixCachedPipeline
+from fuzzy_align import (align_chapter, number_sentences, parse_span,
+                         slice_span, verify_decision, verify_span)
+
 
 SYS_PROMPT = """You are a text alignment assistant.
 
@@ -69,6 +79,47 @@ THE BOY WHO LIVED
 <<<OUTPUT_JSON_END>>>"""
 
 
+# Span output: the model names the first and last matching sentence of
+# the numbered reference, and the Chinese text is sliced out locally
+SPAN_SYS_PROMPT = """You are a text alignment assistant.
+
+## Task:
+- You are given a Chinese text as reference, with every sentence numbered [1], [2], ..., and an english json file. You need to find the sentences of the reference that are the Chinese translation of the English text in the json file.
+- DO NOT translate by yourself.
+- Output ONLY the numbers of the first and the last matching sentence.
+
+## Output JSON only:
+{"start": <first sentence number>, "end": <last sentence number>}
+
+## Examples:
+### Example 1
+<<<CHINESE_TEXT_BEGIN>>>
+[1] 第1章
+[2] ⼤难不死的男孩
+[3] THE BOY WHO LIVED
+[4] 家住⼥贞路四号的德思礼夫妇总是得意地说他们是⾮常规矩的⼈家。
+[5] 拜托，拜托了。
+[6] 他们从来跟神秘古怪的事不沾边，因为他们根本不相信那些邪⻔歪道。
+[7] 弗农·德思礼先⽣在⼀家名叫格朗宁的公司做主管，公司⽣产钻机。
+[8] 他⾼⼤魁梧，胖得⼏乎连脖⼦都没了，却蓄着⼀脸⼤胡⼦。
+<<<CHINESE_TEXT_END>>>
+
+<<<ENGLISH_JSON_BEGIN>>>
+{
+  "chunk_file": "chunk_2.wav",
+  "text": " Mr and Mrs Dursley of No. 4 Privet Drive were proud to say that they were perfectly normal, thank you very much. They were the last people you'd expect to be involved in anything strange or mysterious, because they just didn't hold with such nonsense.",
+  "language": "en"
+}
+<<<ENGLISH_JSON_END>>>
+
+<<<OUTPUT_JSON_BEGIN>>>
+{"start": 4, "end": 6}
+<<<OUTPUT_JSON_END>>>"""
+
+# The span answer is about ten tokens; generation stops at its "}"
+SPAN_MAX_NEW_TOKENS = 32
+
+
 def extract_json(text: str):
     start = text.find("{")
     end = text.rfind("}")
@@ -85,15 +136,95 @@ def remove_linebreaks_between_chinese(text: str):
     return text
 
 
-def align_chunk(reference_file: str, json_file: str, pipe, tokenizer):
-    # Load inputs
-    ref_path = Path(reference_file)
-    title_path = ref_path.parent / "title.txt"
-    chinese_text = ref_path.read_text(encoding="utf-8")
-    if "_1.json" in json_file:
-        title_text = Path(title_path).read_text(encoding="utf-8")
-        chinese_text = title_text + "\n\n" + chinese_text
-    metadata = json.loads(Path(json_file).read_text(encoding="utf-8"))
+def chunk_index(path) -> int:
+    return int(re.search(r"chunk_(\d+)", Path(path).name).group(1))
+
+
+class ChapterReference:
+    """
+    The Chinese text of one chapter, read and split into paragraphs once,
+    and where every chunk of it should be.
+
+    Each chunk's span in the English chapter comes from one global
+    alignment of all its transcripts (fuzzy_align.align_chapter). Its
+    relative position there is carried over to the Chinese paragraphs
+    twice, by character offset and by paragraph count, as the translation
+    keeps neither exactly; window() returns the paragraphs covering both
+    estimates, padded by `pad` on each side. Each retry pads retry_scale
+    times more, and the last attempt is the whole chapter. The book title
+    is prepended to a window that starts at the chapter's first paragraph.
+    """
+
+    def __init__(self, reference_file: str, chunk_files,
+                 en_reference_file: str = None, pad: int = 2,
+                 retry_scale: int = 4, max_attempts: int = 3):
+        ref_path = Path(reference_file)
+        title_path = ref_path.parent / "title.txt"
+        self.title = (title_path.read_text(encoding="utf-8")
+                      if title_path.exists() else "")
+        self.text = ref_path.read_text(encoding="utf-8")
+        self.paragraphs = [
+            line.strip() for line in self.text.splitlines() if line.strip()
+        ]
+        self.char_starts = list(itertools.accumulate(
+            (len(p) for p in self.paragraphs), initial=0))
+        self.pad = pad
+        self.retry_scale = retry_scale
+        self.max_attempts = max_attempts
+
+        # chunk file -> its English metadata, in chunk order
+        self.metadata = {
+            str(f): json.loads(Path(f).read_text(encoding="utf-8"))
+            for f in sorted(chunk_files, key=chunk_index)
+        }
+        en_path = Path(en_reference_file or
+                       str(reference_file).replace("text_zh", "text_en"))
+        self.en_text = en_text = en_path.read_text(encoding="utf-8")
+        en_starts = [m.start() for m in re.finditer(r"[^\n]+", en_text)
+                     if m.group().strip()]
+        spans = align_chapter(
+            [m["text"] for m in self.metadata.values()], en_text)
+        # Chinese characters per English one, for check_zh
+        self.length_ratio = self.char_starts[-1] / max(len(en_text), 1)
+        # chunk file -> its (start, end) in the English chapter
+        self.en_spans = {f: (span["start"], span["end"])
+                         for f, span in zip(self.metadata, spans)}
+        # chunk file -> relative (chars, paragraphs) of its start and end
+        self.position = {
+            f: [(offset / len(en_text),
+                 (bisect.bisect_right(en_starts, offset) - 1) / len(en_starts))
+                for offset in (span["start"], span["end"])]
+            for f, span in zip(self.metadata, spans)
+        }
+
+    def _paragraph_estimates(self, chars, paragraphs):
+        total = self.char_starts[-1]
+        by_chars = bisect.bisect_right(self.char_starts, chars * total) - 1
+        by_count = int(paragraphs * len(self.paragraphs))
+        return by_chars, by_count
+
+    def paragraph_range(self, json_file: str, attempt: int = 0):
+        """(first, last + 1) Chinese paragraph of a chunk's window."""
+        n = len(self.paragraphs)
+        if attempt >= self.max_attempts - 1:
+            return 0, n
+        pad = self.pad * self.retry_scale ** attempt
+        start, end = self.position[str(json_file)]
+        lo = max(0, min(self._paragraph_estimates(*start)) - pad)
+        hi = min(n, max(self._paragraph_estimates(*end)) + 1 + pad)
+        return lo, hi
+
+    def window(self, json_file: str, attempt: int = 0) -> str:
+        """The Chinese reference text for a chunk at the given attempt."""
+        lo, hi = self.paragraph_range(json_file, attempt)
+        text = "\n".join(self.paragraphs[lo:hi])
+        if lo == 0 and self.title:
+            text = self.title + "\n\n" + text
+        return text
+
+
+def build_prompt(chinese_text: str, metadata, tokenizer):
+    """Return the prompt for aligning one English chunk json."""
     json_text = json.dumps(metadata, ensure_ascii=False, indent=2)
 
     # Build prompt
@@ -128,19 +259,62 @@ Return ONLY the final JSON object."""
         add_generation_prompt=True,
         enable_thinking=False,
     )
+    return prompt
+
+
+def build_span_prompt(chinese_text: str, metadata, tokenizer):
+    """
+    Return (prompt, spans) for span output: the reference is numbered by
+    number_sentences, and spans maps the numbers back to chinese_text.
+    """
+    numbered, spans = number_sentences(chinese_text)
+    json_text = json.dumps(metadata, ensure_ascii=False, indent=2)
+
+    user_prompt = f"""Here is the numbered Chinese reference text:
+
+<<<CHINESE_TEXT_BEGIN>>>
+{numbered}
+<<<CHINESE_TEXT_END>>>
+
+
+Here is the English JSON:
+<<<ENGLISH_JSON_BEGIN>>>
+{json_text}
+<<<ENGLISH_JSON_END>>>
+
+Now, output the first and last matching sentence numbers.
+Return ONLY the JSON object."""
+
+    messages = [
+        {"role": "system", "content": SPAN_SYS_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+    prompt = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+        enable_thinking=False,
+    )
+    return prompt, spans
+
+
+def prompt_tokens(prompt: str, tokenizer) -> int:
+    return len(tokenizer(prompt, add_special_tokens=False).input_ids)
 
-    # Run inference
-    output = pipe(
-        prompt,
-        temperature=0.1,
-        top_p=0.8,
-        max_new_tokens=2048,
-        return_full_text=False,
-    )[0]["generated_text"]
 
-    # Extract JSON
-    result = extract_json(output)
+def _atomic_write_json(path: str, data):
+    # Write to a temp file and rename, so a crash never leaves a half file
+    tmp_path = path + ".tmp"
+    Path(tmp_path).write_text(
+        json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
 
+
+def error_path(json_file: str) -> str:
+    return json_file.replace(".json", "_error.json")
+
+
+def save_aligned(json_file: str, metadata, result):
     # Overwrite metadata
     result["chunk_file"] = metadata["chunk_file"]
     result["en"] = metadata["text"]
@@ -148,44 +322,313 @@ Return ONLY the final JSON object."""
     # Clean Chinese formatting safely
     result["zh"] = remove_linebreaks_between_chinese(result["zh"])
 
-    # Save
+    # Save, then clear the chunk's error marker: the output is complete
+    # before the marker goes (see read_journal)
     output_file = json_file.replace(".json", "_aligned.json")
-    Path(output_file).write_text(
-        json.dumps(result, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    _atomic_write_json(output_file, result)
+    Path(error_path(json_file)).unlink(missing_ok=True)
 
     print("Saved to", output_file)
     return result
 
 
+def save_error(json_file: str, reason: str = "parse", message: str = "",
+               attempts: int = 1):
+    """Journal a chunk that could not be aligned, and why (see
+    FAILURE_REASONS), after how many attempts."""
+    _atomic_write_json(error_path(json_file), {
+        "chunk_file": Path(json_file).name,
+        "reason": reason,
+        "message": message,
+        "attempts": attempts,
+    })
+
+
+def read_journal(chunks_folder: str):
+    """
+    {chunk json path: journal entry} of the chunks with an error marker.
+    A marker left next to an _aligned.json (a retry that succeeded but
+    was stopped before clearing it) is removed instead.
+    """
+    journal = {}
+    for marker in sorted(Path(chunks_folder).glob("*chunk_*_error.json"),
+                         key=chunk_index):
+        json_file = str(marker).replace("_error.json", ".json")
+        if Path(json_file.replace(".json", "_aligned.json")).exists():
+            marker.unlink()
+            continue
+        # Markers from before the journal are empty
+        entry = json.loads(marker.read_text(encoding="utf-8") or "{}")
+        journal[json_file] = {"reason": "unknown", "attempts": 0, **entry}
+    return journal
+
+
+class AlignmentError(ValueError):
+    """An unusable alignment output, with its reason for the journal."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+FAILURE_REASONS = ("parse", "empty_zh", "length_ratio")
+
+# A zh span more than this many times longer or shorter than the
+# chapter's zh/en length ratio predicts is taken as misaligned
+MAX_LENGTH_RATIO = 3.0
+
+# Decoding per attempt: the first as always, then greedy, then sampling
+# more freely, so that no retry repeats the decode that failed
+DECODING = [
+    {"do_sample": True, "temperature": 0.1, "top_p": 0.8},
+    {"do_sample": False},
+    {"do_sample": True, "temperature": 0.7, "top_p": 0.95},
+]
+
+
+def decoding(attempt: int):
+    return DECODING[min(attempt, len(DECODING) - 1)]
+
+
+def check_zh(zh: str, metadata, chapter: ChapterReference):
+    """Raise AlignmentError if zh is empty or its length is far off."""
+    if not zh.strip():
+        raise AlignmentError("empty_zh", "empty zh in the output")
+    expected = chapter.length_ratio * len(metadata["text"])
+    ratio = len(zh) / max(expected, 1)
+    if not 1 / MAX_LENGTH_RATIO <= ratio <= MAX_LENGTH_RATIO:
+        raise AlignmentError(
+            "length_ratio", f"zh is {ratio:.2f}x the expected length")
+
+
+def failure_reason(error: Exception) -> str:
+    # Anything but a checked alignment is an output that did not parse
+    return getattr(error, "reason", "parse")
+
+
+def align_chunk(
+    chapter: ChapterReference, json_file: str, pipe, tokenizer,
+    span_output: bool = True, windowed: bool = True, first_attempt: int = 0,
+):
+    """
+    Align one chunk json to its window of the Chinese chapter and save it,
+    retrying while the output is unusable (see check_zh), each time in a
+    wider window (see ChapterReference) and with the next decoding (see
+    DECODING). With span_output, the model only names a sentence span and
+    the Chinese text is sliced from the reference; otherwise it copies it
+    out as JSON. windowed=False always sends the whole chapter.
+
+    first_attempt continues the attempts of an earlier run (see
+    read_journal). If every attempt fails, the last error is raised, with
+    the number of attempts made so far in its `attempts`.
+    """
+    metadata = chapter.metadata[str(json_file)]
+    last = chapter.max_attempts - 1
+    for attempt in range(first_attempt, first_attempt + chapter.max_attempts):
+        chinese_text = chapter.window(json_file, attempt if windowed else last)
+        if span_output:
+            prompt, spans = build_span_prompt(chinese_text, metadata, tokenizer)
+        else:
+            prompt = build_prompt(chinese_text, metadata, tokenizer)
+        print(f"{Path(json_file).name}: {prompt_tokens(prompt, tokenizer)} "
+              f"prompt tokens (attempt {attempt + 1})")
+        try:
+            if span_output:
+                output = pipe(
+                    prompt,
+                    max_new_tokens=SPAN_MAX_NEW_TOKENS,
+                    stop_strings=["}"],
+                    return_full_text=False,
+                    **decoding(attempt),
+                )[0]["generated_text"]
+                result = {"zh": slice_span(chinese_text, spans,
+                                           *parse_span(output))}
+            else:
+                # Run inference
+                output = pipe(
+                    prompt,
+                    max_new_tokens=2048,
+                    return_full_text=False,
+                    **decoding(attempt),
+                )[0]["generated_text"]
+                # Extract JSON
+                result = extract_json(output)
+            check_zh(result.get("zh") or "", metadata, chapter)
+        except ValueError as e:
+            error = e
+            error.attempts = attempt + 1
+            print(f"Attempt {attempt + 1} failed ({failure_reason(e)}): {e}")
+            continue
+        return save_aligned(json_file, metadata, result)
+    raise error
+
+
+def accept_fast_path(chapter: ChapterReference, json_file: str, result):
+    """
+    Whether a chunk's align_chunks_zh result can be saved without the LLM:
+    confident, with both cuts on sentence-bead boundaries, its English
+    span judged right by verify_span, and a zh that passes check_zh.
+    """
+    if result["score"] < MIN_CONFIDENCE or not result["exact"]:
+        return False
+    start, end = chapter.en_spans[json_file]
+    metadata = chapter.metadata[json_file]
+    check = verify_span(metadata["text"], chapter.en_text[start:end])
+    if not verify_decision(check["score"]):
+        return False
+    try:
+        check_zh(result["zh"], metadata, chapter)
+    except AlignmentError:
+        return False
+    return True
+
+
 def align_chunks(
-    reference_file: str, chunks_folder: str, model_name: str = "Qwen/Qwen3-8B"
+    reference_file: str,
+    chunks_folder: str,
+    model_name: str = "Qwen/Qwen3-8B",
+    batched: bool = True,
+    memory_budget_gb: float = 8.0,
+    windowed: bool = True,
+    fast_path: bool = True,
+    retry: bool = False,
 ):
+    """
+    Align every chunk json of chunks_folder to the Chinese reference.
+
+    With fast_path, the whole chapter is first aligned without the LLM
+    (bilingual_align.align_chunks_zh), and only the chunks that fail
+    accept_fast_path go on to the model. Each prompt carries only the chunk's
+    window of the chapter (see ChapterReference), wider on every attempt;
+    windowed=False sends the whole chapter every time. The model answers
+    with a sentence span of the numbered reference (see align_chunk).
+
+    With batched=True, all prompts of an attempt are generated together by
+    a BatchGenerator, in batches sized to memory_budget_gb of KV cache.
+    Otherwise chunks are aligned one by one, reusing the cached prefill of
+    SPAN_SYS_PROMPT. A chunk still failing after its last attempt is
+    journaled with the reason in chunk_N_error.json; retry=True re-runs
+    only the journaled chunks, from the attempt each one got to.
+    Prompt tokens per chunk and the total prefill time are printed.
+    """
+    # Only transcripts: not earlier outputs, word sidecars or the manifest
+    chunk_files = sorted(
+        (f for f in Path(chunks_folder).glob("*chunk_*.json")
+         if not f.stem.endswith(("_aligned", "_error", ".words"))),
+        key=chunk_index,
+    )
+    # The whole chapter's chunks, to place each one in it
+    chapter = ChapterReference(reference_file, chunk_files)
+    first_attempt = {str(f): 0 for f in chunk_files}
+
+    if retry:
+        journal = read_journal(chunks_folder)
+        chunk_files = [f for f in chunk_files if str(f) in journal]
+        first_attempt = {f: entry["attempts"] for f, entry in journal.items()}
+        reasons = Counter(entry["reason"] for entry in journal.values())
+        print(f"Retrying {len(chunk_files)} journaled chunks: "
+              + ", ".join(f"{n} {r}" for r, n in reasons.items()))
+        if not chunk_files:
+            return
+    elif fast_path:
+        t0 = time.perf_counter()
+        files = list(chapter.metadata)
+        results = align_chunks_zh(chapter.en_text, chapter.text,
+                                  [chapter.en_spans[f] for f in files])
+        confident = {f for f, res in zip(files, results)
+                     if accept_fast_path(chapter, f, res)}
+        for f, res in zip(files, results):
+            if f in confident:
+                save_aligned(f, chapter.metadata[f], {"zh": res["zh"]})
+        chunk_files = [f for f in chunk_files if str(f) not in confident]
+        print(f"Fast path aligned {len(confident)}/{len(files)} chunks in "
+              f"{time.perf_counter() - t0:.2f} s, {len(chunk_files)} "
+              f"left for the LLM")
+        if not chunk_files:
+            return
+
     # Load model
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForCausalLM.from_pretrained(
         model_name, torch_dtype="auto", device_map="auto"
     )
-    pipe = pipeline("text-generation", model=model, tokenizer=tokenizer)
-    chunk_files = sorted(Path(chunks_folder).glob("*.json"))
+
+    if batched:
+        batcher = BatchGenerator(model, tokenizer,
+                                 memory_budget_gb=memory_budget_gb)
+        last = chapter.max_attempts - 1
+        # chunk -> its next attempt; chunk -> (reason, message, attempts)
+        pending = {str(f): first_attempt[str(f)] for f in chunk_files}
+        failures = {}
+        total_tokens = 0
+        for _ in range(chapter.max_attempts):
+            # Chunks on the same attempt share its window size and decoding
+            by_attempt = {}
+            for f, attempt in pending.items():
+                by_attempt.setdefault(attempt, []).append(f)
+            pending = {}
+            for attempt, files in sorted(by_attempt.items()):
+                texts = [chapter.window(f, attempt if windowed else last)
+                         for f in files]
+                prompts, spans = zip(*(
+                    build_span_prompt(text, chapter.metadata[f], tokenizer)
+                    for f, text in zip(files, texts)
+                ))
+                tokens = [prompt_tokens(p, tokenizer) for p in prompts]
+                total_tokens += sum(tokens)
+                print(f"Attempt {attempt + 1}: {len(prompts)} prompts, "
+                      f"{sum(tokens) / len(tokens):.0f} prompt tokens per chunk")
+                results = batcher.run(
+                    list(prompts), parse_span,
+                    max_new_tokens=SPAN_MAX_NEW_TOKENS, stop_strings=["}"],
+                    **decoding(attempt),
+                )
+                for chunk_file, text, sent_spans, (span, error) in zip(
+                        files, texts, spans, results):
+                    meta = chapter.metadata[chunk_file]
+                    try:
+                        if error is not None:
+                            raise error
+                        zh = slice_span(text, sent_spans, *span)
+                        check_zh(zh, meta, chapter)
+                    except Exception as e:
+                        print(f"Error processing {chunk_file}: {e}")
+                        failures[chunk_file] = (failure_reason(e), str(e),
+                                                attempt + 1)
+                        pending[chunk_file] = attempt + 1
+                        continue
+                    save_aligned(chunk_file, meta, {"zh": zh})
+            if not pending:
+                break
+        for chunk_file in pending:
+            save_error(chunk_file, *failures[chunk_file])
+        print(f"{total_tokens} prompt tokens, prefill "
+              f"{sum(batcher.ttft):.1f} s in total; {len(pending)} chunks "
+              f"journaled as failed")
+        return
+
+    # SPAN_SYS_PROMPT is prefilled once and reused by every chunk
+    pipe = PrefixCachedPipeline(model, tokenizer, [SPAN_SYS_PROMPT])
+    failed = 0
     for chunk_file in tqdm(chunk_files):
         try:
             print("Processing", chunk_file)
             align_chunk(
-                reference_file=reference_file,
+                chapter=chapter,
                 json_file=str(chunk_file),
                 pipe=pipe,
                 tokenizer=tokenizer,
+                windowed=windowed,
+                first_attempt=first_attempt[str(chunk_file)],
             )
         except Exception as e:
             print(f"Error processing {chunk_file}: {e}")
-            output_file = str(chunk_file).replace(".json", "_error.json")
-            Path(output_file).write_text(
-                json.dumps({}, ensure_ascii=False, indent=2),
-                encoding="utf-8",
-            )
+            attempts = getattr(e, "attempts", first_attempt[str(chunk_file)] + 1)
+            save_error(str(chunk_file), failure_reason(e), str(e), attempts)
+            failed += 1
             continue
+    print(f"Prefill {sum(pipe.ttft):.1f} s in total; {failed} chunks "
+          f"journaled as failed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,365 @@
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from fuzzy_align import split_sentences
+
+
+# ===========================================
+# Anchors
+# ===========================================
+# Names and places that the translation keeps, English pattern -> Chinese
+ANCHORS = {
+    r"\bDursleys?\b": "德思礼",
+    r"\bPrivet Drive\b": "女贞路",
+    r"\bPotters?\b": "波特",
+    r"\bHarry\b": "哈利",
+    r"\bDudley\b": "达力",
+    r"\bVernon\b": "弗农",
+    r"\bPetunia\b": "佩妮",
+    r"\bDumbledore\b": "邓布利多",
+    r"\bMcGonagall\b": "麦格",
+    r"\bHagrid\b": "海格",
+    r"\bVoldemort\b": "伏地魔",
+    r"\bGrunnings\b": "格朗宁",
+    r"\bSirius\b": "小天狼星",
+    r"\bMuggles?\b": "麻瓜",
+    r"\bHogwarts\b": "霍格沃茨",
+    r"\bGringotts\b": "古灵阁",
+    r"\bRon\b": "罗恩",
+    r"\bHermione\b": "赫敏",
+    r"\bSnape\b": "斯内普",
+    r"\bMalfoy\b": "马尔福",
+    r"\bQuirrell\b": "奇洛",
+    r"\bNeville\b": "纳威",
+    r"\bBristol\b": "布里斯托尔",
+    r"\bowls?\b": "猫头鹰",
+}
+_ANCHORS = [(re.compile(en, re.IGNORECASE), zh) for en, zh in ANCHORS.items()]
+
+_EN_NUMBERS = {
+    w: i + 1 for i, w in enumerate(
+        "one two three four five six seven eight nine ten eleven twelve "
+        "thirteen fourteen fifteen sixteen seventeen eighteen nineteen "
+        "twenty".split())
+}
+_ZH_DIGITS = {c: i for i, c in enumerate("零一二三四五六七八九")}
+_EN_CHAPTER = re.compile(r"\bchapter\s+(\w+)", re.IGNORECASE)
+_ZH_CHAPTER = re.compile(r"第\s*([0-9零一二三四五六七八九十]+)\s*章")
+_DIGITS = re.compile(r"\d+")
+
+
+def _zh_number(text):
+    if text.isdigit():
+        return int(text)
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        return (_ZH_DIGITS.get(tens, 1) * 10) + _ZH_DIGITS.get(ones, 0)
+    return _ZH_DIGITS.get(text)
+
+
+def anchors_en(text):
+    """Counter of the anchors of an English text."""
+    found = Counter()
+    for pattern, zh in _ANCHORS:
+        found[zh] += len(pattern.findall(text))
+    for m in _EN_CHAPTER.finditer(text):
+        word = m.group(1).lower()
+        number = int(word) if word.isdigit() else _EN_NUMBERS.get(word)
+        if number:
+            found[f"chapter {number}"] += 1
+    for m in _DIGITS.finditer(_EN_CHAPTER.sub("", text)):
+        found[f"number {int(m.group())}"] += 1
+    return +found
+
+
+def anchors_zh(text):
+    """Counter of the anchors of a Chinese text."""
+    # The books use compatibility forms, e.g. the Kangxi radical ⼥ for 女
+    text = unicodedata.normalize("NFKC", text)
+    found = Counter()
+    for _, zh in _ANCHORS:
+        found[zh] += text.count(zh)
+    for m in _ZH_CHAPTER.finditer(text):
+        number = _zh_number(m.group(1))
+        if number:
+            found[f"chapter {number}"] += 1
+    for m in _DIGITS.finditer(_ZH_CHAPTER.sub("", text)):
+        found[f"number {int(m.group())}"] += 1
+    return +found
+
+
+# ===========================================
+# Length-based sentence alignment
+# ===========================================
+# Gale & Church (1993) bead priors, as -log P; 1-3 and 3-1 for Chinese,
+# which splits and joins English sentences more often
+BEADS = {
+    (1, 1): -math.log(0.89),
+    (1, 0): -math.log(0.0099 / 2),
+    (0, 1): -math.log(0.0099 / 2),
+    (2, 1): -math.log(0.089 / 2),
+    (1, 2): -math.log(0.089 / 2),
+    (2, 2): -math.log(0.011),
+    (3, 1): -math.log(0.005),
+    (1, 3): -math.log(0.005),
+}
+# Variance of the translated length per source character, in units of
+# the mean ratio (6.8 in Gale & Church for c = 1)
+LENGTH_VARIANCE = 6.8
+ANCHOR_BONUS = 2.0  # per anchor found on both sides of a bead
+ANCHOR_PENALTY = 0.5  # per anchor on one side only
+_erfc = np.frompyfunc(math.erfc, 1, 1)
+
+
+def _length_cost(l1, l2, ratio):
+    # -log P(|delta| this large) of the length difference under N(0, 1)
+    mean = (l1 + l2 / ratio) / 2
+    delta = (l2 - l1 * ratio) / np.sqrt(np.maximum(mean, 1) * LENGTH_VARIANCE * ratio)
+    p = _erfc(np.abs(delta) / math.sqrt(2)).astype(float)
+    return -np.log(np.maximum(p, 1e-12))
+
+
+def _band_values(row, cols):
+    # Values of a banded row (lo, vals) at columns cols, inf outside
+    lo, vals = row
+    idx = cols - lo
+    inside = (idx >= 0) & (idx < len(vals))
+    out = np.full(len(cols), np.inf)
+    out[inside] = vals[idx[inside]]
+    return out
+
+
+def align_sentences(en_lengths, zh_lengths, en_anchors, zh_anchors, band=None):
+    """
+    Gale-Church alignment of two sentence sequences by their lengths,
+    boosted by shared anchors (count arrays, one row per sentence).
+
+    The DP is restricted to band sentences around the diagonal and only
+    that band of every row is stored, so time and memory are linear in
+    the chapter length. Chinese sentences after the last bead
+    are free, as the translation ends with its footnotes. Returns the
+    beads as (i0, i1, j0, j1): English sentences i0:i1 translate to
+    Chinese sentences j0:j1.
+    """
+    n, m = len(en_lengths), len(zh_lengths)
+    if band is None:
+        band = max(30, abs(n - m) + n // 10)
+    ratio = sum(zh_lengths) / max(sum(en_lengths), 1)
+    en_len = np.concatenate([[0], np.cumsum(en_lengths)])
+    zh_len = np.concatenate([[0], np.cumsum(zh_lengths)])
+    en_anc = np.vstack([np.zeros((1, en_anchors.shape[1])),
+                        np.cumsum(en_anchors, axis=0)])
+    zh_anc = np.vstack([np.zeros((1, zh_anchors.shape[1])),
+                        np.cumsum(zh_anchors, axis=0)])
+    zh_count = np.asarray(zh_anchors).sum(axis=1)
+
+    # Row i of the DP is (lo, costs of columns lo ... lo + band width)
+    cost, back = [], []
+    beads = list(BEADS)
+    insert = beads.index((0, 1))
+    for i in range(n + 1):
+        center = i * m // max(n, 1)
+        lo, hi = max(0, center - band), min(m, center + band)
+        j = np.arange(lo, hi + 1)
+        row = np.full(len(j), np.inf)
+        row_back = np.zeros(len(j), dtype=np.int8)
+        if i == 0 and lo == 0:
+            row[0] = 0.0
+        for b, (di, dj) in enumerate(beads):
+            if di == 0 or di > i:
+                continue
+            jj = j[j >= dj]
+            if not len(jj):
+                continue
+            prev = _band_values(cost[i - di], jj - dj)
+            l1 = en_len[i] - en_len[i - di]
+            l2 = zh_len[jj] - zh_len[jj - dj]
+            c = prev + BEADS[(di, dj)]
+            if dj:
+                c = c + _length_cost(l1, l2, ratio)
+            a = en_anc[i] - en_anc[i - di]
+            z = zh_anc[jj] - zh_anc[jj - dj]
+            shared = np.minimum(a, z).sum(axis=1)
+            c = c - ANCHOR_BONUS * shared + ANCHOR_PENALTY * (
+                a.sum() + z.sum(axis=1) - 2 * shared)
+            at = jj - lo
+            better = c < row[at]
+            row[at[better]] = c[better]
+            row_back[at[better]] = b
+        # A Chinese-only sentence extends this same row, so it has to be
+        # relaxed left to right after the other beads
+        for k in range(1, len(j)):
+            c = row[k - 1] + BEADS[(0, 1)] + ANCHOR_PENALTY * zh_count[j[k] - 1]
+            if c < row[k]:
+                row[k] = c
+                row_back[k] = insert
+        cost.append((lo, row))
+        back.append((lo, row_back))
+
+    result = []
+    lo, row = cost[n]
+    i, j = n, lo + int(np.argmin(row))
+    while i > 0 or j > 0:
+        lo, row_back = back[i]
+        di, dj = beads[row_back[j - lo]]
+        result.append((i - di, i, j - dj, j))
+        i, j = i - di, j - dj
+    return result[::-1]
+
+
+# ===========================================
+# Chunk projection
+# ===========================================
+# Below this score a chunk's Chinese span is left to the LLM
+MIN_CONFIDENCE = 0.6
+_CLAUSE_END = re.compile(r"[，；：—]+[”’」』]*")
+_CLOSING = "”’\"'」』)）"
+
+
+def _ending(text):
+    """How a text ends: "sentence", "clause" or "word", and whether in a
+    closing quote."""
+    stripped = text.rstrip().rstrip(_CLOSING)
+    quoted = len(stripped) < len(text.rstrip())
+    if stripped.endswith(tuple(".!?。！？…")):
+        return "sentence", quoted
+    if stripped.endswith(tuple(",;:，；：—-")):
+        return "clause", quoted
+    return "word", quoted
+
+
+def _anchor_matrix(counters, keys):
+    return np.array([[c[k] for k in keys] for c in counters],
+                    dtype=float).reshape(len(counters), len(keys))
+
+
+def align_chunks_zh(en_text, zh_text, en_spans):
+    """
+    Give every chunk, by its (start, end) span in en_text, a Chinese span
+    of zh_text, from one sentence alignment of the whole chapter.
+
+    A chunk boundary inside an English bead is carried over by its
+    relative position in the bead and snapped to the nearest Chinese
+    sentence (or, less likely, clause) end there. The spans are contiguous and do not
+    overlap. Each gets a score in [0, 1] from its length ratio against
+    the chapter's, the anchors its two sides share, whether both sides
+    end alike (a sentence, in quotes) and whether both of its cuts fell
+    on bead boundaries ("exact"); see MIN_CONFIDENCE. Interpolated cuts
+    are where most wrong spans come from, score as they may.
+    """
+    en_sents = split_sentences(en_text)
+    zh_sents = split_sentences(zh_text)
+    en_counts = [anchors_en(en_text[s:e]) for s, e in en_sents]
+    zh_counts = [anchors_zh(zh_text[s:e]) for s, e in zh_sents]
+    keys = sorted(set().union(*en_counts, *zh_counts))
+    beads = align_sentences(
+        [e - s for s, e in en_sents], [e - s for s, e in zh_sents],
+        _anchor_matrix(en_counts, keys), _anchor_matrix(zh_counts, keys))
+
+    def project(offset):
+        # (Chinese offset, exact) for an English offset
+        for i0, i1, j0, j1 in beads:
+            if i1 == i0 or en_sents[i1 - 1][1] <= offset:
+                continue
+            zh_lo = zh_sents[j0][0] if j1 > j0 else (
+                zh_sents[j0][0] if j0 < len(zh_sents) else len(zh_text))
+            en_lo, en_hi = en_sents[i0][0], en_sents[i1 - 1][1]
+            if offset <= en_lo or j1 == j0:
+                return zh_lo, True
+            zh_hi = zh_sents[j1 - 1][1]
+            guess = zh_lo + (offset - en_lo) / (en_hi - en_lo) * (zh_hi - zh_lo)
+            # Sentence ends are likelier chunk ends than clause ends
+            cuts = [(abs(zh_sents[j][0] - guess), zh_sents[j][0])
+                    for j in range(j0, j1)] + [(abs(zh_hi - guess), zh_hi)]
+            cuts += [(2 * abs(zh_lo + m.end() - guess), zh_lo + m.end())
+                     for m in _CLAUSE_END.finditer(zh_text[zh_lo:zh_hi])]
+            return min(cuts)[1], False
+        # Past the last bead: the end of its Chinese, not the footnotes
+        j1 = max(j1 for _, _, _, j1 in beads)
+        return (zh_sents[j1 - 1][1] if j1 else 0), True
+
+    cuts = [project(en_spans[0][0])]
+    cuts += [project(start) for start, _ in en_spans[1:]]
+    cuts.append(project(en_spans[-1][1]))
+    ratio = sum(e - s for s, e in zh_sents) / max(sum(e - s for s, e in en_sents), 1)
+
+    results = []
+    last = 0
+    for k, (en_start, en_end) in enumerate(en_spans):
+        start = max(cuts[k][0], last)
+        end = max(cuts[k + 1][0], start)
+        last = end
+        text = zh_text[start:end]
+        start += len(text) - len(text.lstrip())
+        end -= len(text) - len(text.rstrip())
+        end = max(start, end)
+        zh = zh_text[start:end]
+
+        en = en_text[en_start:en_end]
+        exact = cuts[k][1] and cuts[k + 1][1]
+        if not zh or not en:
+            score = 0.0
+        else:
+            r = len(zh) / (ratio * len(en))
+            a, z = anchors_en(en), anchors_zh(zh)
+            total = max(sum(a.values()), sum(z.values()))
+            agree = sum((a & z).values()) / total if total else 1.0
+            # A sentence should end on both sides, or on neither
+            (en_end, en_quote), (zh_end, zh_quote) = _ending(en), _ending(zh)
+            ends = (1.0 if en_end == zh_end else 0.7) * (
+                1.0 if en_quote == zh_quote else 0.85)
+            score = (math.exp(-abs(math.log(r))) * (0.5 + 0.5 * agree)
+                     * (1.0 if exact else 0.9) * ends)
+        results.append({"zh": zh, "start": start, "end": end,
+                        "score": round(score, 3), "exact": exact})
+    return results
+
+
+def show_alignment(en_text, zh_text, en_spans, results, width=24):
+    """Print the ends of every chunk's English and Chinese span, to check
+    the alignment by eye."""
+    for k, ((s, e), res) in enumerate(zip(en_spans, results), 1):
+        en = en_text[s:e].replace("\n", " ")
+        zh = res["zh"].replace("\n", " ")
+        print(f"{k:3d} {res['score']:.2f} | {en[:width]} ... {en[-width:]}")
+        print(f"         | {zh[:width // 2]} ... {zh[-width // 2:]}")
+
+
+if __name__ == "__main__":
+    import glob
+    import json
+    import os
+
+    from fuzzy_align import align_chapter
+
+    chunks_folder = "data/HP1/audio_en/ch1_chunks"
+    paths = sorted(
+        (p for p in glob.glob(os.path.join(chunks_folder, "chunk_*.json"))
+         if re.fullmatch(r"chunk_\d+\.json", os.path.basename(p))),
+        key=lambda p: int(re.findall(r"\d+", os.path.basename(p))[0]),
+    )
+    sources = []
+    for p in paths:
+        with open(p, "r", encoding="utf-8") as f:
+            sources.append(json.load(f)["text"])
+    with open("data/HP1/text_en/1/ch1.txt", "r", encoding="utf-8") as f:
+        en_text = f.read()
+    with open("data/HP1/text_zh/1/ch1.txt", "r", encoding="utf-8") as f:
+        zh_text = f.read()
+
+    t0 = time.perf_counter()
+    en_spans = [(s["start"], s["end"]) for s in align_chapter(sources, en_text)]
+    t1 = time.perf_counter()
+    results = align_chunks_zh(en_text, zh_text, en_spans)
+    t2 = time.perf_counter()
+    show_alignment(en_text, zh_text, en_spans, results)
+    confident = [r for r in results if r["score"] >= MIN_CONFIDENCE]
+    print(f"EN alignment {t1 - t0:.2f} s, EN->ZH {t2 - t1:.2f} s; "
+          f"{len(confident)}/{len(results)} chunks at confidence >= "
+          f"{MIN_CONFIDENCE}, {sum(r['exact'] for r in confident)} of them "
+          f"with exact cuts")
@@ -1,10 +1,15 @@
 import sys
 import re
+import os
+import json
+import mmap
+import time
 import jieba
 import nltk
 nltk.download('punkt_tab')
 from langdetect import detect
 from rank_bm25 import BM25Okapi
+import numpy as np
 
 # Ensure nltk tokenizer is available
 nltk.download("punkt", quiet=True)
@@ -28,6 +33,14 @@ def tokenize_mixed(text):
     return tokens
 
 
+# Tokenizers by name, as recorded in a saved index
+TOKENIZERS = {
+    "english": tokenize_english,
+    "chinese": tokenize_chinese,
+    "mixed": tokenize_mixed,
+}
+
+
 def choose_tokenizer(text):
     """Detect language and return appropriate tokenizer."""
     try:
@@ -68,10 +81,70 @@ def chunk_text(text, tokenizer, chunk_size=300, overlap=50):
     return chunks
 
 
+# ===========================================
+# Memory-mapped strings
+# ===========================================
+class MappedStrings:
+    """
+    A read-only list of strings stored as one UTF-8 blob plus an array of
+    byte offsets, both memory-mapped: nothing is read until accessed, and
+    processes that map the same files share their pages.
+    """
+
+    def __init__(self, blob_path, offsets):
+        self.offsets = offsets
+        with open(blob_path, "rb") as f:
+            # mmap cannot map an empty file
+            self.data = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                         if os.fstat(f.fileno()).st_size else b"")
+
+    def raw(self, i):
+        return self.data[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.raw(i).decode("utf-8")
+
+    def get(self, term, default=None):
+        """Index of term, for strings sorted by their UTF-8 bytes."""
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.raw(lo) == key:
+            return lo
+        return default
+
+
+def write_strings(blob_path, strings):
+    """Write strings as a blob and return their byte offsets."""
+    encoded = [s.encode("utf-8") for s in strings]
+    with open(blob_path, "wb") as f:
+        for e in encoded:
+            f.write(e)
+    return np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.int64)
+
+
 # ===========================================
 # BM25 Search Engine Class
 # ===========================================
+INDEX_VERSION = 1
+
+
 class BM25SearchEngine:
+    """
+    BM25 over overlapping chunks of a text. Scores come from per-term
+    postings (chunk ids and term frequencies), with the same arithmetic
+    as BM25Okapi.get_scores, so an index saved with save() and opened
+    with load() ranks exactly like a freshly built one.
+    """
+
     def __init__(self, text):
         print("🔍 Detecting language...")
         self.tokenizer = choose_tokenizer(text)
@@ -86,24 +159,155 @@ class BM25SearchEngine:
 
         print("⚙️  Building BM25 index...")
         self.bm25 = BM25Okapi(tokenized_chunks)
+        self._build_postings()
 
         print("🎉 BM25 index built successfully!")
 
+    def _build_postings(self):
+        bm25 = self.bm25
+        # Sorted by UTF-8 bytes, as MappedStrings.get expects
+        terms = sorted(bm25.idf, key=lambda t: t.encode("utf-8"))
+        self.terms = terms
+        self.vocab = {t: i for i, t in enumerate(terms)}
+        postings = [[] for _ in terms]
+        for doc_id, freqs in enumerate(bm25.doc_freqs):
+            for term, tf in freqs.items():
+                postings[self.vocab[term]].append((doc_id, tf))
+        self.offsets = np.concatenate(
+            [[0], np.cumsum([len(p) for p in postings])]).astype(np.int64)
+        flat = [pair for p in postings for pair in p]
+        self.doc_ids = np.array([d for d, _ in flat], dtype=np.int32)
+        self.tfs = np.array([tf for _, tf in flat], dtype=np.int32)
+        self.idf = np.array([bm25.idf[t] for t in terms], dtype=np.float64)
+        self.doc_len = np.array(bm25.doc_len, dtype=np.int64)
+        self.k1, self.b, self.avgdl = bm25.k1, bm25.b, bm25.avgdl
+
+    def get_scores(self, query_tokens):
+        """BM25 score of every chunk, as BM25Okapi.get_scores."""
+        scores = np.zeros(len(self.doc_len))
+        for token in query_tokens:
+            i = self.vocab.get(token)
+            if i is None:
+                continue
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            ids, tf = self.doc_ids[lo:hi], self.tfs[lo:hi]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[ids] / self.avgdl)
+            scores[ids] += self.idf[i] * (tf * (self.k1 + 1) / (tf + norm))
+        return scores
+
+    def top_k(self, query_tokens, k=5):
+        """
+        The k best (chunk id, score) pairs, ranked exactly as sorting
+        get_scores would (ties go to the lower chunk id). Only the
+        chunks tied with or above the k-th best score get sorted.
+        """
+        scores = self.get_scores(query_tokens)
+        ids = np.arange(len(scores))
+        if k < len(scores):
+            ids = np.flatnonzero(scores >= np.partition(scores, -k)[-k])
+        best = ids[np.lexsort((ids, -scores[ids]))][:k]
+        return [(int(i), float(scores[i])) for i in best]
+
+    def save(self, path):
+        """
+        Write the index to the directory path: vocabulary, postings, idf,
+        chunk lengths and chunk texts as flat arrays and blobs that load()
+        memory-maps. meta.json is removed first and written last, so an
+        interrupted save (also over an older index) is never loaded.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        np.save(os.path.join(path, "terms.npy"),
+                write_strings(os.path.join(path, "terms.bin"), self.terms))
+        np.save(os.path.join(path, "chunks.npy"),
+                write_strings(os.path.join(path, "chunks.bin"), self.chunks))
+        for name in ("offsets", "doc_ids", "tfs", "idf", "doc_len"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        tokenizer = next(name for name, fn in TOKENIZERS.items()
+                         if fn is self.tokenizer)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "tokenizer": tokenizer,
+                       "k1": self.k1, "b": self.b, "avgdl": self.avgdl}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        print(f"💾 Saved index to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """Open an index written by save(), memory-mapped and read-only."""
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] != INDEX_VERSION:
+            raise ValueError(f"Index version {meta['version']} in {path}, "
+                             f"expected {INDEX_VERSION}")
+
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        engine = cls.__new__(cls)
+        engine.tokenizer = TOKENIZERS[meta["tokenizer"]]
+        engine.bm25 = None
+        engine.terms = engine.vocab = MappedStrings(
+            os.path.join(path, "terms.bin"), array("terms"))
+        engine.chunks = MappedStrings(
+            os.path.join(path, "chunks.bin"), array("chunks"))
+        for name in ("offsets", "doc_ids", "tfs", "idf", "doc_len"):
+            setattr(engine, name, array(name))
+        engine.k1, engine.b, engine.avgdl = meta["k1"], meta["b"], meta["avgdl"]
+        return engine
+
     def search(self, query, top_k=5):
         query_tokens = self.tokenizer(query)
-        scores = self.bm25.get_scores(query_tokens)
-        ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
 
         results = []
-        for idx, score in ranked[:top_k]:
+        for idx, score in self.top_k(query_tokens, top_k):
             results.append({
                 "chunk_id": idx,
-                "score": float(score),
+                "score": score,
                 "text": self.chunks[idx][:300] + "..."
             })
         return results
 
 
+# ===========================================
+# Benchmark
+# ===========================================
+def benchmark_qps(corpora, num_queries=200, top_k=5, seed=0):
+    """
+    Queries per second, for each (label, text) in corpora (e.g. one
+    chapter, one book, all books), of three ways to rank: BM25Okapi's
+    get_scores plus a full sort, the postings get_scores plus a full sort
+    (how search ranked before top_k), and top_k. The speedup is top_k's
+    over the postings sort. Queries are 1-6 tokens drawn from the corpus
+    itself; tokenizing is not timed.
+    """
+    rng = np.random.default_rng(seed)
+    print(f"{'corpus':>12} {'chunks':>7} {'postings':>9} {'okapi q/s':>10} "
+          f"{'sort q/s':>9} {'top_k q/s':>10} {'speedup':>8}")
+    for label, text in corpora:
+        engine = BM25SearchEngine(text)
+        tokens = [t for chunk in engine.chunks for t in engine.tokenizer(chunk)]
+        queries = [[tokens[j] for j in rng.integers(len(tokens), size=n)]
+                   for n in rng.integers(1, 7, size=num_queries)]
+
+        qps = []
+        for rank in (
+                lambda q: sorted(enumerate(engine.bm25.get_scores(q)),
+                                 key=lambda x: x[1], reverse=True)[:top_k],
+                lambda q: sorted(enumerate(engine.get_scores(q)),
+                                 key=lambda x: x[1], reverse=True)[:top_k],
+                lambda q: engine.top_k(q, top_k)):
+            t = time.perf_counter()
+            for q in queries:
+                rank(q)
+            qps.append(num_queries / (time.perf_counter() - t))
+
+        okapi, full, fast = qps
+        print(f"{label:>12} {len(engine.chunks):7d} {len(engine.doc_ids):9d} "
+              f"{okapi:10.0f} {full:9.0f} {fast:10.0f} {fast / full:7.1f}x")
+
+
 # ===========================================
 # Interactive Search CLI
 # ===========================================
@@ -128,9 +332,15 @@ def interactive_search(engine):
 if __name__ == "__main__":
     filename = "/home/bo/workspace/transcribe_and_align/data/HP1/text_en/1/ch1.txt"
 
-    print(f"📂 Loading file: {filename}")
-    with open(filename, "r", encoding="utf-8") as f:
-        text = f.read()
-
-    engine = BM25SearchEngine(text)
+    # Build once, then open the saved index on later starts
+    index_dir = filename + ".bm25"
+    if os.path.exists(os.path.join(index_dir, "meta.json")):
+        print(f"📂 Loading index: {index_dir}")
+        engine = BM25SearchEngine.load(index_dir)
+    else:
+        print(f"📂 Loading file: {filename}")
+        with open(filename, "r", encoding="utf-8") as f:
+            text = f.read()
+        engine = BM25SearchEngine(text)
+        engine.save(index_dir)
     interactive_search(engine)
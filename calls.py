@@ -0,0 +1,213 @@
+import copy
+import time
+
+import torch
+from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList
+
+
+def system_prefix(tokenizer, sys_prompt):
+    """
+    The start of every chat prompt that uses sys_prompt: the rendered
+    system turn, up to where the user turn begins.
+    """
+    return tokenizer.apply_chat_template(
+        [{"role": "system", "content": sys_prompt}],
+        tokenize=False,
+        add_generation_prompt=False,
+    )
+
+
+class _FirstTokenTimer(LogitsProcessor):
+    # Logits processors first run once the prefill forward pass is done
+    def __init__(self):
+        self.t_first = None
+
+    def __call__(self, input_ids, scores):
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+        return scores
+
+
+class PrefixCachedPipeline:
+    """
+    Drop-in for a transformers text-generation pipeline whose prompts
+    start with one of a few fixed, long system prompts.
+
+    Each fixed prefix is prefilled once and its past key/values kept; a
+    prompt starting with it only prefills its own suffix, on a copy of the
+    cache. Called like the pipeline:
+        pipe(prompt, temperature=..., max_new_tokens=..., return_full_text=False)
+    and returns [{"generated_text": ...}]. stop_strings=[...] ends
+    generation as soon as one of them is produced.
+
+    Every call records its time to first token (prefill) in self.ttft, so
+    use_cache=False gives the baseline to compare against.
+    """
+
+    def __init__(self, model, tokenizer, sys_prompts=(), use_cache=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.use_cache = use_cache
+        self.prefixes = {}  # prefix text -> (prefix ids, cache)
+        self.ttft = []
+        for sys_prompt in sys_prompts:
+            self.add_prefix(system_prefix(tokenizer, sys_prompt))
+
+    def add_prefix(self, text):
+        if not self.use_cache or text in self.prefixes:
+            return
+        ids = self.tokenizer(text, return_tensors="pt",
+                             add_special_tokens=False).input_ids
+        ids = ids.to(self.model.device)
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            cache = self.model(ids, past_key_values=DynamicCache(),
+                               use_cache=True).past_key_values
+        print(f"Cached {ids.shape[1]} prefix tokens in "
+              f"{time.perf_counter() - t0:.2f} s")
+        self.prefixes[text] = (ids, cache)
+
+    def _cache_for(self, prompt, input_ids):
+        for text, (ids, cache) in self.prefixes.items():
+            n = ids.shape[1]
+            # Token-level check: the prefix must tokenize the same in place
+            if (prompt.startswith(text) and input_ids.shape[1] > n
+                    and torch.equal(input_ids[0, :n], ids[0])):
+                return copy.deepcopy(cache)
+        return None
+
+    def __call__(self, prompt, return_full_text=False, **generate_kwargs):
+        input_ids = self.tokenizer(prompt, return_tensors="pt",
+                                   add_special_tokens=False).input_ids
+        input_ids = input_ids.to(self.model.device)
+
+        if "stop_strings" in generate_kwargs:
+            generate_kwargs["tokenizer"] = self.tokenizer
+        timer = _FirstTokenTimer()
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=self._cache_for(prompt, input_ids),
+                logits_processor=LogitsProcessorList([timer]),
+                **generate_kwargs,
+            )
+        self.ttft.append(timer.t_first - t0)
+
+        new_tokens = output[0, input_ids.shape[1]:]
+        text = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+        if return_full_text:
+            text = prompt + text
+        return [{"generated_text": text}]
+
+
+def compare_ttft(model, tokenizer, sys_prompts, prompts, **generate_kwargs):
+    """
+    Run the same prompts without and with the prefix cache and print the
+    mean time to first token of each.
+    """
+    result = {}
+    for use_cache in (False, True):
+        pipe = PrefixCachedPipeline(model, tokenizer, sys_prompts,
+                                    use_cache=use_cache)
+        for prompt in prompts:
+            pipe(prompt, **generate_kwargs)
+        result[use_cache] = sum(pipe.ttft) / len(pipe.ttft)
+    print(f"TTFT without prefix cache: {result[False]:.2f} s, "
+          f"with: {result[True]:.2f} s "
+          f"({result[False] / result[True]:.1f}x)")
+    return result
+
+
+class BatchGenerator:
+    """
+    Generate many independent prompts in left-padded batches.
+
+    Batches are formed from prompts of similar length (longest first), as
+    large as fits memory_budget_gb of KV cache for prompt + max_new_tokens,
+    and never over max_batch_size. Outputs come back in input order.
+
+    The prefill time of every batch (to its first token) is recorded in
+    self.ttft.
+    """
+
+    def __init__(self, model, tokenizer, memory_budget_gb=4.0,
+                 max_batch_size=16):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.memory_budget = memory_budget_gb * 1024 ** 3
+        self.max_batch_size = max_batch_size
+        self.ttft = []
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+    def kv_bytes_per_token(self):
+        config = self.model.config
+        n_heads = config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or n_heads
+        head_dim = (getattr(config, "head_dim", None)
+                    or config.hidden_size // n_heads)
+        # keys and values, for every layer
+        return (2 * config.num_hidden_layers * kv_heads * head_dim
+                * self.model.dtype.itemsize)
+
+    def plan_batches(self, lengths, max_new_tokens):
+        """Group prompt indices into batches that fit the memory budget."""
+        per_token = self.kv_bytes_per_token()
+        batches = []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            if batches:
+                batch = batches[-1]
+                padded = lengths[batch[0]] + max_new_tokens
+                if (len(batch) < self.max_batch_size and
+                        (len(batch) + 1) * padded * per_token <= self.memory_budget):
+                    batch.append(i)
+                    continue
+            batches.append([i])
+        return batches
+
+    def generate(self, prompts, max_new_tokens=2048, **generate_kwargs):
+        if not prompts:
+            return []
+        lengths = [
+            len(ids) for ids in self.tokenizer(
+                prompts, add_special_tokens=False).input_ids
+        ]
+        if "stop_strings" in generate_kwargs:
+            generate_kwargs["tokenizer"] = self.tokenizer
+        outputs = [None] * len(prompts)
+        self.tokenizer.padding_side = "left"
+        for batch in self.plan_batches(lengths, max_new_tokens):
+            print(f"Generating a batch of {len(batch)} "
+                  f"(prompts up to {lengths[batch[0]]} tokens)")
+            enc = self.tokenizer([prompts[i] for i in batch],
+                                 return_tensors="pt", padding=True,
+                                 add_special_tokens=False).to(self.model.device)
+            timer = _FirstTokenTimer()
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                out = self.model.generate(**enc, max_new_tokens=max_new_tokens,
+                                          pad_token_id=self.tokenizer.pad_token_id,
+                                          logits_processor=LogitsProcessorList([timer]),
+                                          **generate_kwargs)
+            self.ttft.append(timer.t_first - t0)
+            texts = self.tokenizer.batch_decode(
+                out[:, enc.input_ids.shape[1]:], skip_special_tokens=True)
+            for i, text in zip(batch, texts):
+                outputs[i] = text
+        return outputs
+
+    def run(self, prompts, parse, **generate_kwargs):
+        """
+        Generate all prompts and parse each output on its own: returns
+        [(result, error)], with error the exception of an item whose
+        output could not be parsed, so one bad output never fails the batch.
+        """
+        results = []
+        for text in self.generate(prompts, **generate_kwargs):
+            try:
+                results.append((parse(text), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
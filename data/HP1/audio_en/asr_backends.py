@@ -0,0 +1,302 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import torch
+import whisper
+from whisper.audio import N_SAMPLES, SAMPLE_RATE
+from whisper.tokenizer import get_tokenizer
+
+# Seconds per Whisper timestamp token
+TIME_PRECISION = 0.02
+
+
+class ASRBackend(ABC):
+    """
+    A transcription engine behind transcribe_audio.transcribe_chunks.
+
+    transcribe() takes 16 kHz mono float32 audio and returns a dict with
+    "text", "language", "segments" (id/start/end/text) and "words"
+    (word/start/end/probability, empty unless word timestamps are on).
+    The model is loaded on first use.
+
+    language, when set, is passed to every decode instead of detecting it
+    per call; transcribe_chunks pins it once per book with detect_language.
+    """
+    name = None
+
+    def __init__(self, model_name, **options):
+        self.model_name = model_name
+        self.options = options
+        self.language = None
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            print(f"Loading {self.name} model {self.model_name}...")
+            self._model = self.load_model()
+        return self._model
+
+    @abstractmethod
+    def load_model(self):
+        """Load and return the model."""
+
+    @abstractmethod
+    def transcribe(self, audio):
+        """Transcribe one audio array (see the class docstring)."""
+
+    def transcribe_batch(self, audios):
+        return [self.transcribe(audio) for audio in audios]
+
+    def detect_language(self, audio):
+        """Language code spoken in (the first 30 s of) audio."""
+        return self.transcribe(audio[:N_SAMPLES])["language"]
+
+    def cache_options(self, batched=False):
+        """Decode settings that go into the transcript cache key."""
+        return {"backend": self.name, "language": self.language,
+                **self.options}
+
+
+def _segments_from_tokens(tokenizer, tokens, duration):
+    """
+    Rebuild id/start/end/text segments from the timestamp tokens of one
+    decoded window (<|t0|> text <|t1|><|t1|> text <|t2|> ...), like
+    whisper.transcribe does.
+    """
+    segments = []
+    start = None
+    text_tokens = []
+    for token in tokens:
+        if token < tokenizer.timestamp_begin:
+            text_tokens.append(token)
+            continue
+        time = (token - tokenizer.timestamp_begin) * TIME_PRECISION
+        if start is None:
+            start = time
+        elif text_tokens:
+            segments.append({"id": len(segments), "start": start, "end": time,
+                             "text": tokenizer.decode(text_tokens)})
+            start = None
+            text_tokens = []
+    if text_tokens:
+        segments.append({"id": len(segments), "start": start or 0.0,
+                         "end": round(duration, 2),
+                         "text": tokenizer.decode(text_tokens)})
+    return segments
+
+
+def transcribe_batch(model, audios, language=None):
+    """
+    Transcribe several <=30 s float32 audio arrays at once: their log-mel
+    spectrograms are stacked so the encoder runs once per batch and the
+    decoder decodes all of them together (greedy, with timestamps).
+
+    Returns one result dict per audio with the same text/language/segments
+    keys as model.transcribe. Unlike model.transcribe there is no
+    temperature fallback or conditioning on previous text.
+    """
+    # Pad the audio, not the log-mel: a log-mel of zeros is not silence
+    mel = torch.stack([
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(a),
+                                    n_mels=model.dims.n_mels)
+        for a in audios
+    ]).to(model.device)
+
+    options = whisper.DecodingOptions(language=language, fp16=False)
+    decoded = whisper.decode(model, mel, options)
+
+    tokenizer = get_tokenizer(model.is_multilingual,
+                              num_languages=model.num_languages,
+                              task="transcribe")
+    results = []
+    for audio, res in zip(audios, decoded):
+        segments = _segments_from_tokens(tokenizer, res.tokens,
+                                         len(audio) / SAMPLE_RATE)
+        results.append({
+            "text": "".join(seg["text"] for seg in segments),
+            "language": res.language,
+            "segments": segments,
+            "words": [],
+        })
+    return results
+
+
+def _whisper_result(result):
+    segments = result.get("segments", [])
+    return {
+        "text": result.get("text", ""),
+        "language": result.get("language", ""),
+        "segments": [
+            {k: seg.get(k) for k in ("id", "start", "end", "text")}
+            for seg in segments
+        ],
+        "words": [
+            {k: w.get(k) for k in ("word", "start", "end", "probability")}
+            for seg in segments
+            for w in seg.get("words", [])
+        ],
+    }
+
+
+class WhisperBackend(ASRBackend):
+    """openai-whisper at full precision (the original engine)."""
+    name = "whisper"
+
+    def __init__(self, model_name="large", fp16=False, word_timestamps=False):
+        super().__init__(model_name, fp16=fp16, word_timestamps=word_timestamps)
+
+    def load_model(self):
+        return whisper.load_model(self.model_name)
+
+    def transcribe(self, audio):
+        return _whisper_result(self.model.transcribe(
+            audio, language=self.language, **self.options))
+
+    def transcribe_batch(self, audios):
+        # Chunks that fit one 30 s window are decoded in one batch; longer
+        # ones need whisper's sliding window and go through transcribe, as
+        # do all chunks when word timestamps are wanted.
+        results = [None] * len(audios)
+        short = [] if self.options["word_timestamps"] else [
+            i for i, a in enumerate(audios) if len(a) <= N_SAMPLES]
+        for i, a in enumerate(audios):
+            if i not in short:
+                results[i] = self.transcribe(a)
+        if short:
+            batch = transcribe_batch(self.model, [audios[i] for i in short],
+                                     language=self.language)
+            for i, result in zip(short, batch):
+                results[i] = result
+        return results
+
+    def detect_language(self, audio):
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio),
+                                          n_mels=self.model.dims.n_mels)
+        _, probs = self.model.detect_language(mel.to(self.model.device))
+        return max(probs, key=probs.get)
+
+    def cache_options(self, batched=False):
+        options = {"language": self.language, **self.options}
+        if batched and not self.options["word_timestamps"]:
+            options["batched"] = True
+        return options
+
+
+class FasterWhisperBackend(ASRBackend):
+    """
+    faster-whisper (CTranslate2) with int8 weights on CPU by default.
+    Needs the optional faster-whisper package.
+    """
+    name = "faster-whisper"
+
+    def __init__(self, model_name="large", compute_type="int8", device="cpu",
+                 cpu_threads=0, word_timestamps=False, beam_size=5):
+        super().__init__(model_name, word_timestamps=word_timestamps,
+                         beam_size=beam_size)
+        self.compute_type = compute_type
+        self.device = device
+        self.cpu_threads = cpu_threads
+
+    def load_model(self):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError(
+                "The faster-whisper backend needs `pip install faster-whisper`."
+            ) from e
+        return WhisperModel(self.model_name, device=self.device,
+                            compute_type=self.compute_type,
+                            cpu_threads=self.cpu_threads)
+
+    def transcribe(self, audio):
+        segments, info = self.model.transcribe(audio, language=self.language,
+                                               **self.options)
+        segments = list(segments)  # decoding happens while iterating
+        return {
+            "text": "".join(seg.text for seg in segments),
+            "language": info.language,
+            "segments": [
+                {"id": i, "start": seg.start, "end": seg.end, "text": seg.text}
+                for i, seg in enumerate(segments)
+            ],
+            "words": [
+                {"word": w.word, "start": w.start, "end": w.end,
+                 "probability": w.probability}
+                for seg in segments
+                for w in (seg.words or [])
+            ],
+        }
+
+    def detect_language(self, audio):
+        # Detection runs eagerly in transcribe; the segments are never decoded
+        _, info = self.model.transcribe(audio[:N_SAMPLES])
+        return info.language
+
+    def cache_options(self, batched=False):
+        return {"backend": self.name, "compute_type": self.compute_type,
+                "language": self.language, **self.options}
+
+
+class StubBackend(ASRBackend):
+    """
+    Deterministic fake engine with no model weights, for testing and
+    benchmarking the rest of the pipeline: one segment per started
+    `segment_sec` of audio, whose text encodes its time span and loudness.
+    """
+    name = "stub"
+
+    def __init__(self, model_name="stub", segment_sec=5.0,
+                 word_timestamps=False):
+        super().__init__(model_name, segment_sec=segment_sec,
+                         word_timestamps=word_timestamps)
+
+    def load_model(self):
+        return self.name
+
+    def transcribe(self, audio):
+        step = int(self.options["segment_sec"] * SAMPLE_RATE)
+        segments = []
+        words = []
+        for i, lo in enumerate(range(0, len(audio), step)):
+            piece = audio[lo: lo + step]
+            start = round(lo / SAMPLE_RATE, 2)
+            end = round(min(lo + step, len(audio)) / SAMPLE_RATE, 2)
+            rms = float(np.sqrt(np.mean(np.square(piece, dtype=np.float64))))
+            tokens = ["Segment", f"{start:.2f}", "to", f"{end:.2f},",
+                      "level", f"{rms:.3f}."]
+            segments.append({"id": i, "start": start, "end": end,
+                             "text": " " + " ".join(tokens)})
+            if not self.options["word_timestamps"]:
+                continue
+            span = (end - start) / len(tokens)
+            words += [
+                {"word": " " + w, "start": round(start + j * span, 2),
+                 "end": round(start + (j + 1) * span, 2), "probability": 1.0}
+                for j, w in enumerate(tokens)
+            ]
+        return {
+            "text": "".join(seg["text"] for seg in segments),
+            "language": self.language or "en",
+            "segments": segments,
+            "words": words,
+        }
+
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+    StubBackend.name: StubBackend,
+}
+
+
+def make_backend(backend="whisper", model_name="large", **options):
+    """Return an ASRBackend instance for a backend name (or pass one through)."""
+    if isinstance(backend, ASRBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ASR backend {backend!r}, "
+                         f"choose from {sorted(BACKENDS)}.")
+    if backend == StubBackend.name:
+        return StubBackend(**options)
+    return BACKENDS[backend](model_name, **options)
@@ -1,12 +1,37 @@
+import glob
+import inspect
+import json
 import math
 import os
-
+import re
+import subprocess
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+import numpy as np
 import webrtcvad
 from pydub import AudioSegment
 
 SAMPLE_RATE = 16000
 SAMPLE_WIDTH = 2  # bytes
 CHANNELS = 1
+BYTES_PER_MS = SAMPLE_RATE * SAMPLE_WIDTH * CHANNELS // 1000
+WHISPER_WINDOW_SEC = 30.0  # Whisper pads every input to a 30 s mel window
+# Default chunk ceiling; unbroken speech is force-cut at it, which bounds
+# the memory of the streaming splitter
+MAX_CHUNK_SEC = 120.0
+
+# Virtual chunks: one raw PCM file per chapter plus a manifest of chunk spans
+PCM_FILE = "audio.pcm"
+MANIFEST_FILE = "manifest.json"
+
+# Written last into a chunk folder; records the source file and settings
+SPLIT_MARKER = "split_done.json"
+# Split settings recorded in SPLIT_MARKER (block_sec does not change output)
+SPLIT_PARAMS = ("silence_ms", "frame_ms", "vad_mode", "min_chunk_sec",
+                "max_chunk_sec", "pack_sec", "virtual")
 
 
 def load_mp3_as_pcm(path: str) -> AudioSegment:
@@ -23,13 +48,94 @@ def load_mp3_as_pcm(path: str) -> AudioSegment:
     return audio
 
 
+def classify_frames(pcm, vad, frame_ms: int = 30,
+                    silence_rms: Optional[float] = None,
+                    speech_rms: Optional[float] = None):
+    """
+    Classify every full frame of 16-bit mono PCM as speech (True) or not.
+
+    Frames are numpy/memoryview views into pcm, never copies. A vectorized
+    RMS pre-pass marks frames with rms <= silence_rms as silence and frames
+    with rms >= speech_rms as speech; only the frames in between are passed
+    to vad.is_speech. None disables that side of the pre-pass.
+
+    WebRTC VAD carries hangover and noise-model state from frame to frame,
+    so every skipped frame (even digital silence) can shift the decisions
+    that follow. With both thresholds None (the default) every frame goes
+    to the VAD and the result is identical to the frame-by-frame loop, at
+    about the same speed: the VAD call itself dominates. Only setting the
+    thresholds makes it faster, at the cost of exactness.
+    """
+    bytes_per_frame = frame_ms * BYTES_PER_MS
+    samples_per_frame = bytes_per_frame // SAMPLE_WIDTH
+    n_frames = len(pcm) // bytes_per_frame
+
+    samples = np.frombuffer(pcm, dtype=np.int16,
+                            count=n_frames * samples_per_frame)
+    frames = samples.reshape(n_frames, samples_per_frame)
+
+    is_speech = np.zeros(n_frames, dtype=bool)
+    ambiguous = np.ones(n_frames, dtype=bool)
+    if silence_rms is not None or speech_rms is not None:
+        energy = np.einsum("ij,ij->i", frames, frames, dtype=np.int64)
+        rms = np.sqrt(energy / samples_per_frame)
+        if silence_rms is not None:
+            ambiguous &= rms > silence_rms
+        if speech_rms is not None:
+            loud = rms >= speech_rms
+            is_speech[loud] = True
+            ambiguous &= ~loud
+
+    view = memoryview(pcm).cast("B")
+    idx = np.flatnonzero(ambiguous)
+    offsets = (idx * bytes_per_frame).tolist()
+    is_speech[idx] = [
+        vad.is_speech(view[o: o + bytes_per_frame], SAMPLE_RATE)
+        for o in offsets
+    ]
+    return is_speech
+
+
+def find_cut_frames(is_speech, frames_needed: int, silent_run: int = 0):
+    """
+    Vectorized splitting rule of the VAD loop: every time frames_needed
+    consecutive non-speech frames are seen, cut AFTER the last one and
+    restart the count.
+
+    silent_run is the non-speech run carried over from a previous block.
+    Returns (cut_frames, silent_run) with cuts relative to this block.
+    """
+    n = len(is_speech)
+    speech_idx = np.flatnonzero(is_speech)
+
+    # Non-speech runs between speech frames; the first run continues the
+    # one carried over from the previous block.
+    starts = np.concatenate(([-silent_run], speech_idx + 1))
+    ends = np.concatenate((speech_idx, [n]))
+    lengths = ends - starts
+
+    counts = lengths // frames_needed
+    total = int(counts.sum())
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    k = np.arange(total) - first + 1
+    cuts = np.repeat(starts, counts) + k * frames_needed
+
+    return cuts.tolist(), int(lengths[-1] % frames_needed)
+
+
 def detect_segments_ms(audio: AudioSegment,
                        silence_ms: int = 1000,
                        frame_ms: int = 30,
-                       vad_mode: int = 3):
+                       vad_mode: int = 3,
+                       silence_rms: Optional[float] = None,
+                       speech_rms: Optional[float] = None,
+                       max_segment_ms: Optional[int] = None):
     """
     Use WebRTC VAD to find segment boundaries, return a list of
     (start_ms, end_ms) that together exactly cover the whole audio.
+
+    See classify_frames for the energy pre-pass thresholds, and
+    force_cut_frames for max_segment_ms.
     """
 
     if frame_ms not in (10, 20, 30):
@@ -37,40 +143,24 @@ def detect_segments_ms(audio: AudioSegment,
 
     vad = webrtcvad.Vad(vad_mode)
 
-    samples_per_frame = int(SAMPLE_RATE * frame_ms / 1000)
-    bytes_per_frame = samples_per_frame * SAMPLE_WIDTH * CHANNELS
-
     raw = audio.raw_data
     total_ms = len(audio)  # pydub gives duration in ms
 
-    # Number of *full* frames we can read
-    n_frames = len(raw) // bytes_per_frame
-
     frames_needed = math.ceil(silence_ms / frame_ms)
 
-    segment_start_frame = 0
-    silent_run = 0
-    segment_starts = [0]  # in frames
-
-    for i in range(n_frames):
-        offset = i * bytes_per_frame
-        frame = raw[offset: offset + bytes_per_frame]
-
-        if len(frame) != bytes_per_frame:
-            break
-
-        is_speech = vad.is_speech(frame, SAMPLE_RATE)
-
-        if not is_speech:
-            silent_run += 1
-        else:
-            silent_run = 0
-
-        # If we’ve seen enough consecutive non-speech, split AFTER this frame
-        if silent_run >= frames_needed:
-            cut_frame = i + 1  # cut after current frame
-            segment_starts.append(cut_frame)
-            silent_run = 0
+    is_speech = classify_frames(raw, vad, frame_ms,
+                                silence_rms=silence_rms,
+                                speech_rms=speech_rms)
+    cut_frames, _ = find_cut_frames(is_speech, frames_needed)
+    if max_segment_ms is not None:
+        energy = frame_energy(raw, frame_ms)
+        max_frames = max(1, max_segment_ms // frame_ms)
+        bounds = [0] + cut_frames + [len(is_speech)]
+        forced = []
+        for s, e in zip(bounds, bounds[1:]):
+            forced += force_cut_frames(energy, s, e, max_frames)
+        cut_frames = sorted(cut_frames + forced)
+    segment_starts = [0] + cut_frames  # in frames
 
     # Convert frame-based boundaries to ms, ensuring full coverage
     segments_ms = []
@@ -91,70 +181,256 @@ def detect_segments_ms(audio: AudioSegment,
     return segments_ms
 
 
-def merge_short_segments(segments_ms, min_chunk_sec=5.0):
+def benchmark_vad(path: str, frame_ms: int = 30, vad_mode: int = 3,
+                  **prepass):
+    """
+    Print the frame classification throughput (frames per second) for one
+    file, with and without the energy pre-pass thresholds in prepass.
+    """
+    raw = load_mp3_as_pcm(path).raw_data
+    n_frames = len(raw) // (frame_ms * BYTES_PER_MS)
+
+    for label, kwargs in (("vad only", {"silence_rms": None}),
+                          ("pre-pass", prepass)):
+        vad = webrtcvad.Vad(vad_mode)
+        t0 = time.perf_counter()
+        classify_frames(raw, vad, frame_ms, **kwargs)
+        elapsed = time.perf_counter() - t0
+        print(f"{label}: {n_frames} frames in {elapsed:.3f} s "
+              f"→ {n_frames / elapsed:,.0f} frames/s")
+
+
+def merge_short_segments_stream(segments_ms, min_chunk_sec=5.0,
+                                max_chunk_sec=None):
+    """
+    Single pass over the segments: a short segment is absorbed by its
+    predecessor (or by its successor at the very start), and each merged
+    chunk is yielded as soon as it can no longer grow.
+
+    With max_chunk_sec, a short segment that would push a long-enough
+    chunk past the limit starts the next chunk instead. Chunks can still
+    end up longer than the limit when a single segment is; use
+    split_long_segments for those.
+    """
+    min_ms = int(min_chunk_sec * 1000)
+    max_ms = None if max_chunk_sec is None else int(max_chunk_sec * 1000)
+    pending = None
+
+    for s, e in segments_ms:
+        if pending is None:
+            pending = [s, e]
+        elif pending[1] - pending[0] < min_ms:
+            pending[1] = e
+        elif e - s < min_ms and (max_ms is None or e - pending[0] <= max_ms):
+            pending[1] = e
+        else:
+            yield pending
+            pending = [s, e]
+
+    if pending is not None:
+        yield pending
+
+
+def frame_energy(pcm, frame_ms=30):
+    """Sum of squared samples of every full frame of 16-bit mono PCM."""
+    samples_per_frame = frame_ms * BYTES_PER_MS // SAMPLE_WIDTH
+    n_frames = len(pcm) // (samples_per_frame * SAMPLE_WIDTH)
+    frames = np.frombuffer(pcm, dtype=np.int16,
+                           count=n_frames * samples_per_frame)
+    frames = frames.reshape(n_frames, samples_per_frame)
+    return np.einsum("ij,ij->i", frames, frames, dtype=np.int64)
+
+
+def force_cut_frames(energy, start, end, max_frames, energy_start=0):
+    """
+    Cuts (in frames) that break the VAD segment [start, end) into pieces
+    of at most max_frames, each at the quietest frame within max_frames
+    of the previous cut. energy holds frame energies from energy_start on.
+
+    A cut only depends on the frames before it, so the streaming and the
+    in-memory splitter find the same cuts whatever the block size.
+    """
+    cuts = []
+    while end - start > max_frames:
+        lo = start + 1 - energy_start
+        start += 1 + int(np.argmin(energy[lo: lo + max_frames]))
+        cuts.append(start)
+    return cuts
+
+
+def quietest_cut_ms(pcm, lo_ms, hi_ms, frame_ms=30, pcm_start_ms=0):
+    """
+    Return the start (in ms) of the lowest-energy frame lying inside
+    [lo_ms, hi_ms]. pcm is 16-bit mono PCM starting at pcm_start_ms.
+    """
+    first = math.ceil(lo_ms / frame_ms)
+    last = max(first + 1, hi_ms // frame_ms)
+    samples_per_frame = frame_ms * BYTES_PER_MS // SAMPLE_WIDTH
+
+    offset = (first * frame_ms - pcm_start_ms) * BYTES_PER_MS
+    count = (last - first) * samples_per_frame
+    frames = np.frombuffer(pcm, dtype=np.int16, count=count,
+                           offset=offset).reshape(-1, samples_per_frame)
+    energy = np.einsum("ij,ij->i", frames, frames, dtype=np.int64)
+    return (first + int(np.argmin(energy))) * frame_ms
+
+
+def split_long_segments(segments_ms, pcm, max_chunk_sec,
+                        min_chunk_sec=5.0, frame_ms=30, pcm_start_ms=0):
+    """
+    Split every segment longer than max_chunk_sec at the quietest frame
+    inside it, keeping pieces at least min_chunk_sec long where possible.
+    Pieces stay contiguous, so coverage is unchanged.
+    """
+    max_ms = int(max_chunk_sec * 1000)
+    min_ms = min(int(min_chunk_sec * 1000), max_ms // 2)
+
+    for s, e in segments_ms:
+        while e - s > max_ms:
+            # At least one frame in, so every piece moves forward
+            lo = s + max(min_ms, frame_ms)
+            cut = quietest_cut_ms(pcm,
+                                  lo,
+                                  max(lo, min(s + max_ms, e - min_ms)),
+                                  frame_ms=frame_ms,
+                                  pcm_start_ms=pcm_start_ms)
+            if cut <= s:
+                cut = s + max_ms
+            yield [s, cut]
+            s = cut
+        yield [s, e]
+
+
+def merge_short_segments(segments_ms, min_chunk_sec=5.0,
+                         max_chunk_sec=None, pcm=None, frame_ms=30):
     """
     Merge segments shorter than min_chunk_sec with neighbors
-    WITHOUT dropping any time.
+    WITHOUT dropping any time, in linear time.
 
     segments_ms: list of [start_ms, end_ms], contiguous & covering the full audio.
+    max_chunk_sec: optional ceiling; longer chunks are split at their
+    quietest frame, which needs the 16-bit mono pcm of the whole audio.
     """
-    min_ms = int(min_chunk_sec * 1000)
-    segs = [list(s) for s in segments_ms]
+    merged = merge_short_segments_stream(segments_ms,
+                                         min_chunk_sec=min_chunk_sec,
+                                         max_chunk_sec=max_chunk_sec)
+    if max_chunk_sec is None:
+        return list(merged)
 
-    i = 0
-    while i < len(segs):
-        s, e = segs[i]
-        dur = e - s
+    if pcm is None:
+        raise ValueError("pcm is required to split chunks at max_chunk_sec.")
+    return list(split_long_segments(merged, pcm, max_chunk_sec,
+                                    min_chunk_sec=min_chunk_sec,
+                                    frame_ms=frame_ms))
 
-        # If segment long enough or only one segment, keep as is
-        if dur >= min_ms or len(segs) == 1:
-            i += 1
-            continue
 
-        # Too short -> merge
-        if i == 0:
-            # Merge into next: [s0,e0] + [s1,e1] -> [s0,e1], drop seg0
-            segs[1][0] = s
-            del segs[0]
-            # i stays 0 to re-check new seg[0]
+def pack_segments_stream(segments_ms, window_sec=WHISPER_WINDOW_SEC):
+    """
+    Greedily group adjacent segments into chunks as close to window_sec
+    as possible, cutting only at segment (i.e. silence) boundaries.
+    A single segment longer than the window is yielded on its own.
+    """
+    window_ms = int(window_sec * 1000)
+    pending = None
+
+    for s, e in segments_ms:
+        if pending is None:
+            pending = [s, e]
+        elif e - pending[0] <= window_ms:
+            pending[1] = e
         else:
-            # Merge into previous: [s_{i-1}, e_{i-1}] + [s_i, e_i]
-            segs[i-1][1] = e
-            del segs[i]
-            i -= 1  # re-check previous after enlargement
+            yield pending
+            pending = [s, e]
 
-    return segs
+    if pending is not None:
+        yield pending
+
+
+def padding_stats(segments_ms, window_sec=WHISPER_WINDOW_SEC):
+    """
+    Return (n_windows, padding_ratio) for transcribing each chunk with
+    Whisper: every chunk costs ceil(duration / window_sec) encoder passes,
+    and padding_ratio is the share of encoded audio that is padding.
+    """
+    window_ms = int(window_sec * 1000)
+    audio_ms = sum(e - s for s, e in segments_ms)
+    n_windows = sum(math.ceil((e - s) / window_ms) for s, e in segments_ms)
+    if n_windows == 0:
+        return 0, 0.0
+    return n_windows, 1 - audio_ms / (n_windows * window_ms)
+
+
+def print_padding_stats(segments_ms, window_sec=WHISPER_WINDOW_SEC):
+    n_windows, ratio = padding_stats(segments_ms, window_sec)
+    audio_h = sum(e - s for s, e in segments_ms) / 3_600_000
+    per_hour = n_windows / audio_h if audio_h else 0.0
+    print(f"Whisper windows: {n_windows} ({per_hour:.0f} per hour of audio), "
+          f"padding ratio: {ratio:.1%}")
 
 
 def split_audio_on_silence(path: str,
                          silence_ms: int = 1000,
                          frame_ms: int = 30,
                          vad_mode: int = 3,
-                         min_chunk_sec: float = 5.0):
+                         min_chunk_sec: float = 5.0,
+                         max_chunk_sec: Optional[float] = MAX_CHUNK_SEC,
+                         pack_sec: Optional[float] = None,
+                         virtual: bool = False):
     """
     High-level function:
-    1. Detect segments via VAD
-    2. Merge segments shorter than min_chunk_sec
-    3. Export each as a WAV file
+    1. Detect segments via VAD, force-cutting unbroken speech longer
+       than max_chunk_sec (or pack_sec) as the streaming splitter does
+    2. Merge segments shorter than min_chunk_sec, split those longer
+       than max_chunk_sec (if given) at their quietest frame.
+       With pack_sec (e.g. WHISPER_WINDOW_SEC), segments are instead packed
+       greedily into chunks of up to pack_sec, so fewer chunks pay for a
+       padded Whisper window. Packing works best with a shorter silence_ms
+       (e.g. 300), which gives it more boundaries to choose from.
+    3. Export each as a WAV file, or with virtual=True write the whole
+       PCM once plus a manifest of chunk spans (see export_chunk_wavs)
 
     No samples are dropped: final chunks cover exactly [0, total_audio_duration].
     """
+    params = {k: v for k, v in locals().items() if k in SPLIT_PARAMS}
     audio = load_mp3_as_pcm(path)
 
     # 1. Detect raw segments from VAD
-    segments_ms = detect_segments_ms(audio,
-                                     silence_ms=silence_ms,
-                                     frame_ms=frame_ms,
-                                     vad_mode=vad_mode)
-
-    # 2. Merge too-short segments
-    merged_segments = merge_short_segments(segments_ms,
-                                           min_chunk_sec=min_chunk_sec)
+    max_sec = pack_sec if pack_sec is not None else max_chunk_sec
+    segments_ms = detect_segments_ms(
+        audio,
+        silence_ms=silence_ms,
+        frame_ms=frame_ms,
+        vad_mode=vad_mode,
+        max_segment_ms=None if max_sec is None else int(max_sec * 1000))
+
+    # 2. Merge too-short segments, or pack them up to the Whisper window
+    if pack_sec is not None:
+        packed = pack_segments_stream(segments_ms, window_sec=pack_sec)
+        merged_segments = list(split_long_segments(packed, audio.raw_data,
+                                                   pack_sec,
+                                                   min_chunk_sec=min_chunk_sec,
+                                                   frame_ms=frame_ms))
+    else:
+        merged_segments = merge_short_segments(segments_ms,
+                                               min_chunk_sec=min_chunk_sec,
+                                               max_chunk_sec=max_chunk_sec,
+                                               pcm=audio.raw_data,
+                                               frame_ms=frame_ms)
 
     # 3. Export each segment using time slicing (no raw-byte concat)
     base = os.path.splitext(path)[0]
     base = f"{base}_chunks"
     os.makedirs(base, exist_ok=True)
+    if virtual:
+        with open(os.path.join(base, PCM_FILE), "wb") as f:
+            f.write(audio.raw_data)
+        write_manifest(base, merged_segments)
+        print("Done. Total chunks:", len(merged_segments))
+        print_padding_stats(merged_segments)
+        remove_stale_chunks(base, len(merged_segments), virtual=True)
+        write_split_marker(base, path, merged_segments, params)
+        return base
+
     for idx, (start_ms, end_ms) in enumerate(merged_segments, start=1):
         chunk = audio[start_ms:end_ms]
         out_path = os.path.join(base, f"chunk_{idx}.wav")
@@ -162,9 +438,431 @@ def split_audio_on_silence(path: str,
         print(f"Saved: {out_path}  [{start_ms} ms → {end_ms} ms]")
 
     print("Done. Total chunks:", len(merged_segments))
+    print_padding_stats(merged_segments)
+    remove_stale_chunks(base, len(merged_segments))
+    write_split_marker(base, path, merged_segments, params)
+    return base
+
+
+def iter_pcm_blocks(path: str, block_sec: float = 10.0):
+    """
+    Decode MP3 (or any audio) with ffmpeg and yield it as fixed-size
+    blocks of 16 kHz mono 16-bit PCM, so the whole file is never held
+    in memory. The last block may be shorter.
+    """
+    block_bytes = int(block_sec * 1000) * BYTES_PER_MS
+    cmd = [
+        AudioSegment.converter, "-nostdin", "-v", "error",
+        "-i", path,
+        "-f", "s16le", "-acodec", "pcm_s16le",
+        "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE),
+        "-",
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    try:
+        while True:
+            block = proc.stdout.read(block_bytes)
+            if not block:
+                break
+            yield block
+    finally:
+        proc.stdout.close()
+        err = proc.stderr.read()
+        proc.stderr.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed on {path}: {err.decode(errors='replace')}")
+
+
+def stream_segments_ms(pcm_blocks,
+                       silence_ms: int = 1000,
+                       frame_ms: int = 30,
+                       vad_mode: int = 3,
+                       silence_rms: Optional[float] = None,
+                       speech_rms: Optional[float] = None,
+                       max_segment_ms: Optional[int] = None):
+    """
+    Streaming version of detect_segments_ms: consume PCM blocks and yield
+    each [start_ms, end_ms] segment as soon as its end boundary is known.
+    The segments together exactly cover the whole stream.
+
+    With max_segment_ms, unbroken speech is cut as in detect_segments_ms
+    (see force_cut_frames); only the frame energies of the open segment
+    are kept for that.
+    """
+
+    if frame_ms not in (10, 20, 30):
+        raise ValueError("frame_ms must be 10, 20, or 30 ms for WebRTC VAD.")
+
+    vad = webrtcvad.Vad(vad_mode)
+
+    bytes_per_frame = frame_ms * BYTES_PER_MS
+    frames_needed = math.ceil(silence_ms / frame_ms)
+
+    max_frames = (None if max_segment_ms is None
+                  else max(1, max_segment_ms // frame_ms))
+
+    carry = b""  # bytes of an incomplete frame left over from the last block
+    total_bytes = 0
+    frame_idx = 0
+    silent_run = 0
+    start = 0  # first frame of the open segment
+    energy = np.zeros(0, dtype=np.int64)  # frame energies from start on
+
+    for block in pcm_blocks:
+        total_bytes += len(block)
+        data = carry + block if carry else block
+        n_frames = len(data) // bytes_per_frame
+
+        is_speech = classify_frames(data, vad, frame_ms,
+                                    silence_rms=silence_rms,
+                                    speech_rms=speech_rms)
+        cut_frames, silent_run = find_cut_frames(is_speech, frames_needed,
+                                                 silent_run)
+        if max_frames is not None:
+            energy_start = start
+            energy = np.concatenate((energy, frame_energy(data, frame_ms)))
+
+        # VAD cuts, then the block end, which only forces cuts
+        end = frame_idx + n_frames
+        for cut in [frame_idx + c for c in cut_frames] + [None]:
+            if max_frames is not None:
+                for forced in force_cut_frames(energy, start,
+                                               end if cut is None else cut,
+                                               max_frames, energy_start):
+                    yield [start * frame_ms, forced * frame_ms]
+                    start = forced
+            if cut is not None:
+                yield [start * frame_ms, cut * frame_ms]
+                start = cut
+
+        if max_frames is not None:
+            energy = energy[start - energy_start:]
+        frame_idx += n_frames
+        carry = data[n_frames * bytes_per_frame:]
+
+    # last segment goes to end of audio (including any leftover <frame_ms)
+    total_ms = round(total_bytes / BYTES_PER_MS)
+    if total_ms > start * frame_ms:
+        yield [start * frame_ms, total_ms]
+
+
+def _write_wav(out_path: str, pcm) -> None:
+    with wave.open(out_path, "wb") as wf:
+        wf.setnchannels(CHANNELS)
+        wf.setsampwidth(SAMPLE_WIDTH)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes(pcm)
+
+
+def write_manifest(chunks_dir: str, segments_ms) -> str:
+    """
+    Write the manifest of virtual chunks: chunk ids, the chunk_N.wav
+    name used in transcripts, and each chunk's span in PCM_FILE.
+    """
+    manifest = {
+        "pcm_file": PCM_FILE,
+        "sample_rate": SAMPLE_RATE,
+        "sample_width": SAMPLE_WIDTH,
+        "channels": CHANNELS,
+        "chunks": [
+            {
+                "chunk_id": idx,
+                "chunk_file": f"chunk_{idx}.wav",
+                "start_ms": start_ms,
+                "end_ms": end_ms,
+            }
+            for idx, (start_ms, end_ms) in enumerate(segments_ms, start=1)
+        ],
+    }
+    out_path = os.path.join(chunks_dir, MANIFEST_FILE)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"Saved manifest: {out_path}")
+    return out_path
+
+
+def read_manifest(chunks_dir: str):
+    """Return the virtual chunk manifest of chunks_dir, or None if absent."""
+    path = os.path.join(chunks_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def export_chunk_wavs(chunks_dir: str, chunk_ids=None):
+    """
+    Write real chunk_N.wav files for virtual chunks (all of them, or only
+    chunk_ids), sliced straight from the memory-mapped PCM file.
+    """
+    manifest = read_manifest(chunks_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_FILE} in {chunks_dir}")
+
+    pcm = np.memmap(os.path.join(chunks_dir, manifest["pcm_file"]),
+                    dtype=np.uint8, mode="r")
+    for chunk in manifest["chunks"]:
+        if chunk_ids is not None and chunk["chunk_id"] not in chunk_ids:
+            continue
+        lo = chunk["start_ms"] * BYTES_PER_MS
+        hi = chunk["end_ms"] * BYTES_PER_MS
+        out_path = os.path.join(chunks_dir, chunk["chunk_file"])
+        _write_wav(out_path, pcm[lo:hi].tobytes())
+        print(f"Saved: {out_path}  [{chunk['start_ms']} ms → {chunk['end_ms']} ms]")
+
+
+def split_audio_on_silence_streaming(path: str,
+                                     silence_ms: int = 1000,
+                                     frame_ms: int = 30,
+                                     vad_mode: int = 3,
+                                     min_chunk_sec: float = 5.0,
+                                     max_chunk_sec: float = MAX_CHUNK_SEC,
+                                     pack_sec: Optional[float] = None,
+                                     virtual: bool = False,
+                                     block_sec: float = 10.0):
+    """
+    Streaming variant of split_audio_on_silence for long audiobooks:
+    the audio is decoded in block_sec blocks, fed frame by frame to the
+    VAD, and every chunk is written as soon as its end boundary is known.
+
+    Only the PCM of the chunk currently being built is kept in memory,
+    and unbroken speech is force-cut at max_chunk_sec (or pack_sec), so
+    peak memory is bounded by the chunk ceiling plus one block, whatever
+    the input length. Chunk boundaries are the same as
+    split_audio_on_silence's for the same settings.
+    With virtual=True the decoded PCM is appended to one PCM_FILE as it
+    arrives and chunks are only recorded in the manifest.
+    No samples are dropped: final chunks cover exactly [0, total_audio_duration].
+    """
+    params = {k: v for k, v in locals().items() if k in SPLIT_PARAMS}
+    if max_chunk_sec is None and pack_sec is None:
+        raise ValueError("max_chunk_sec is required to bound the streaming "
+                         "splitter's memory.")
+    base = os.path.splitext(path)[0]
+    base = f"{base}_chunks"
+    os.makedirs(base, exist_ok=True)
+
+    # PCM decoded so far, starting at buf_start_ms
+    buf = bytearray()
+    buf_start_ms = 0
+
+    pcm_out = open(os.path.join(base, PCM_FILE), "wb") if virtual else None
+
+    def tee(blocks):
+        for block in blocks:
+            buf.extend(block)
+            if pcm_out is not None:
+                pcm_out.write(block)
+            yield block
+
+    if pack_sec is not None:
+        max_chunk_sec = pack_sec
+    segments = stream_segments_ms(
+        tee(iter_pcm_blocks(path, block_sec)),
+        silence_ms=silence_ms,
+        frame_ms=frame_ms,
+        vad_mode=vad_mode,
+        max_segment_ms=int(max_chunk_sec * 1000))
+
+    if pack_sec is not None:
+        chunks = pack_segments_stream(segments, window_sec=pack_sec)
+    else:
+        chunks = merge_short_segments_stream(segments,
+                                             min_chunk_sec=min_chunk_sec,
+                                             max_chunk_sec=max_chunk_sec)
+
+    written = []
+    for seg in chunks:
+        pieces = list(split_long_segments([seg], buf, max_chunk_sec,
+                                          min_chunk_sec=min_chunk_sec,
+                                          frame_ms=frame_ms,
+                                          pcm_start_ms=buf_start_ms))
+        for start_ms, end_ms in pieces:
+            written.append([start_ms, end_ms])
+            lo = (start_ms - buf_start_ms) * BYTES_PER_MS
+            hi = (end_ms - buf_start_ms) * BYTES_PER_MS
+            if not virtual:
+                out_path = os.path.join(base, f"chunk_{len(written)}.wav")
+                _write_wav(out_path, buf[lo:hi])
+                print(f"Saved: {out_path}  [{start_ms} ms → {end_ms} ms]")
+            del buf[:hi]
+            buf_start_ms = end_ms
+
+    if virtual:
+        pcm_out.close()
+        write_manifest(base, written)
+
+    print("Done. Total chunks:", len(written))
+    print_padding_stats(written)
+    remove_stale_chunks(base, len(written), virtual=virtual)
+    write_split_marker(base, path, written, params)
     return base
 
 
+def _source_stamp(path: str):
+    st = os.stat(path)
+    return {"source_size": st.st_size, "source_mtime": st.st_mtime}
+
+
+def remove_stale_chunks(chunks_dir: str, n_chunks: int, virtual: bool = False):
+    """
+    Delete what an earlier split of chunks_dir left behind: chunk_N files
+    (audio and anything derived from it) past the n_chunks just written,
+    chunk WAVs when the new split is virtual, and the PCM file and
+    manifest when it is not. The alignments (chunk_N_aligned.json and
+    chunk_N_error.json) of every chunk go too, as they belong to the old
+    segments; transcripts are rewritten by the next transcription run.
+    """
+    for name in os.listdir(chunks_dir):
+        m = re.match(r"chunk_(\d+)[._]", name)
+        if m is None:
+            continue
+        if (int(m.group(1)) > n_chunks
+                or name.endswith(("_aligned.json", "_error.json"))
+                or (virtual and name.endswith(".wav"))):
+            os.remove(os.path.join(chunks_dir, name))
+    if not virtual:
+        for name in (PCM_FILE, MANIFEST_FILE):
+            if os.path.exists(os.path.join(chunks_dir, name)):
+                os.remove(os.path.join(chunks_dir, name))
+
+
+def write_split_marker(chunks_dir: str, path: str, segments_ms, params):
+    """
+    Mark chunks_dir as complete for this source file and these settings.
+    Written via a temp file and rename, so it only exists after the last
+    chunk was saved.
+    """
+    marker = {
+        **_source_stamp(path),
+        "params": params,
+        "n_chunks": len(segments_ms),
+        "audio_ms": segments_ms[-1][1] if segments_ms else 0,
+    }
+    out_path = os.path.join(chunks_dir, SPLIT_MARKER)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(marker, f, indent=2)
+    os.replace(tmp_path, out_path)
+
+
+def read_split_marker(chunks_dir: str):
+    path = os.path.join(chunks_dir, SPLIT_MARKER)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def effective_params(split_fn, kwargs):
+    """The SPLIT_PARAMS split_fn(path, **kwargs) records in its marker."""
+    bound = inspect.signature(split_fn).bind(None, **kwargs)
+    bound.apply_defaults()
+    return {k: v for k, v in bound.arguments.items() if k in SPLIT_PARAMS}
+
+
+def is_split_current(path: str, params) -> bool:
+    """
+    True if the chunk folder of path was completely written from the
+    current version of the file with the same split settings.
+    """
+    base = f"{os.path.splitext(path)[0]}_chunks"
+    marker = read_split_marker(base)
+    if marker is None:
+        return False
+    stamp = _source_stamp(path)
+    return (marker["source_size"] == stamp["source_size"]
+            and marker["source_mtime"] == stamp["source_mtime"]
+            and marker["params"] == params)
+
+
+def _expand_inputs(pattern: str, exts=(".mp3",)):
+    if os.path.isdir(pattern):
+        paths = [
+            os.path.join(root, f)
+            for root, _, files in os.walk(pattern)
+            for f in files
+            if f.lower().endswith(exts)
+        ]
+    else:
+        paths = glob.glob(pattern, recursive=True)
+    return sorted(paths)
+
+
+def _split_one(split_fn, path, kwargs):
+    t0 = time.perf_counter()
+    base = split_fn(path, **kwargs)
+    elapsed = time.perf_counter() - t0
+    marker = read_split_marker(base)
+    return marker["audio_ms"] / 1000, marker["n_chunks"], elapsed
+
+
+def split_audio_batch(pattern: str,
+                      workers: Optional[int] = None,
+                      streaming: bool = True,
+                      exts=(".mp3",),
+                      **split_kwargs):
+    """
+    Split every audio file under a directory (files ending in exts) or
+    matching a glob pattern, one file per worker process (default: one
+    worker per core). Files whose chunk folder is already complete and
+    current are skipped. split_kwargs go to the split function.
+
+    Prints per-file progress and the aggregate realtime factor
+    (seconds of audio split per wall-clock second).
+    """
+    split_fn = (split_audio_on_silence_streaming if streaming
+                else split_audio_on_silence)
+    params = effective_params(split_fn, split_kwargs)
+
+    paths = _expand_inputs(pattern, exts)
+    todo = [p for p in paths if not is_split_current(p, params)]
+    print(f"Found {len(paths)} files, {len(paths) - len(todo)} already split, "
+          f"{len(todo)} to do.")
+    if not todo:
+        return []
+
+    workers = workers or os.cpu_count()
+    total_audio = 0.0
+    total_cpu = 0.0
+    done = []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_split_one, split_fn, p, split_kwargs): p
+            for p in todo
+        }
+        for fut in as_completed(futures):
+            path = futures[fut]
+            try:
+                audio_sec, n_chunks, elapsed = fut.result()
+            except Exception as e:
+                print(f"Error splitting {path}: {e}")
+                continue
+            done.append(path)
+            total_audio += audio_sec
+            total_cpu += elapsed
+            wall = time.perf_counter() - t0
+            print(f"[{len(done)}/{len(todo)}] {path}: {n_chunks} chunks, "
+                  f"{audio_sec:.0f} s audio in {elapsed:.1f} s "
+                  f"({audio_sec / max(elapsed, 1e-9):.0f}x realtime) | "
+                  f"total {total_audio / 3600:.2f} h in {wall:.0f} s "
+                  f"({total_audio / max(wall, 1e-9):.0f}x realtime)")
+
+    wall = time.perf_counter() - t0
+    if not done or total_cpu <= 0:
+        print(f"Done. {len(done)}/{len(todo)} files in {wall:.1f} s.")
+        return done
+    print(f"Done. {len(done)}/{len(todo)} files, {total_audio / 3600:.2f} h "
+          f"of audio in {wall:.1f} s with {workers} workers: "
+          f"{total_audio / wall:.0f}x realtime overall, "
+          f"{total_audio / total_cpu:.0f}x per worker, "
+          f"speedup {total_cpu / wall:.1f}x.")
+    return done
+
+
 
 if __name__ == "__main__":
     split_audio_on_silence(
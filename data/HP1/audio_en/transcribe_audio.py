@@ -1,67 +1,493 @@
 import os
 import json
+import time
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import torch
 import whisper
+from whisper.audio import N_SAMPLES
 
+from asr_backends import make_backend
+from split_audio import (MAX_CHUNK_SEC, PCM_FILE, SAMPLE_RATE,
+                         effective_params, iter_pcm_blocks,
+                         merge_short_segments,
+                         read_manifest, remove_stale_chunks,
+                         split_audio_on_silence_streaming, stream_segments_ms,
+                         write_manifest, write_split_marker)
 
-def transcribe_chunks(directory=".", whisper_model="large"):
-    """
-    Transcribe all *chunk_*.wav files in the directory using Whisper large model,
-    and save JSON files next to them.
+# Content-addressed transcripts, kept next to the chunks by default
+CACHE_DIR = ".transcribe_cache"
+# Columnar word timestamps of chunk_N.wav go to chunk_N.words.json
+WORDS_SUFFIX = ".words.json"
+
+
+def list_chunks(directory="."):
     """
+    Return [(chunk_file, audio)] for a chunks folder.
 
-    # Load Whisper large model (this can take ~2GB VRAM)
-    print("Loading Whisper large model...")
-    model = whisper.load_model(whisper_model)
+    If the folder holds virtual chunks from split_audio (one PCM file plus
+    a manifest), audio is an int16 slice of the memory-mapped PCM, so no
+    per-chunk WAV is read or decoded. Otherwise audio is the path of each
+    *chunk_*.wav file.
+    """
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        samples = np.memmap(os.path.join(directory, manifest["pcm_file"]),
+                            dtype=np.int16, mode="r")
+        per_ms = SAMPLE_RATE // 1000
+        return [
+            (c["chunk_file"], samples[c["start_ms"] * per_ms: c["end_ms"] * per_ms])
+            for c in manifest["chunks"]
+        ]
 
-    # Find all chunk wav files
     chunk_files = [
         f for f in os.listdir(directory)
         if f.endswith(".wav") and "chunk" in f
     ]
+    return [(wav, os.path.join(directory, wav)) for wav in sorted(chunk_files)]
+
+
+def _atomic_write_json(path, data, compact=False):
+    # Write to a temp file and rename, so a crash never leaves a half file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if compact:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def transcript_cache_key(audio, whisper_model, options):
+    """
+    Hash of the chunk's samples plus the model name and decode options:
+    the same audio transcribed the same way always maps to the same key,
+    whatever its chunk number.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({"model": whisper_model, "options": options},
+                        sort_keys=True).encode("utf-8"))
+    h.update(np.ascontiguousarray(audio).tobytes())
+    return h.hexdigest()
+
+
+def _cache_load(cache_dir, key):
+    path = os.path.join(cache_dir, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def words_sidecar(result):
+    """
+    Word timestamps of a result as parallel arrays, the compact form kept
+    in chunk_N.words.json next to the transcript. None if there are none.
+    """
+    words = result.get("words") or []
+    if not words:
+        return None
+    return {
+        "words": [w["word"] for w in words],
+        "starts": [round(w["start"], 2) for w in words],
+        "ends": [round(w["end"], 2) for w in words],
+        "probabilities": [round(w["probability"], 3) for w in words],
+    }
+
+
+def _words_path(directory, wav):
+    return os.path.join(directory, wav.replace(".wav", WORDS_SUFFIX))
+
+
+def _write_transcript(directory, wav, result, cache_dir=None, key=None):
+    json_path = os.path.join(directory, wav.replace(".wav", ".json"))
+    sidecar = words_sidecar(result)
+
+    # Prepare JSON structure
+    output = {
+        "chunk_file": wav,
+        "text": result.get("text", ""),
+        "language": result.get("language", ""),
+        "segments": [
+            {
+                "id": seg.get("id"),
+                "start": seg.get("start"),
+                "end": seg.get("end"),
+                "text": seg.get("text")
+            }
+            for seg in result.get("segments", [])
+        ]
+    }
+
+    # Cache first, then save JSON next to the chunk file
+    if key is not None:
+        if sidecar is not None:
+            _atomic_write_json(os.path.join(cache_dir, f"{key}{WORDS_SUFFIX}"),
+                               sidecar, compact=True)
+        _atomic_write_json(os.path.join(cache_dir, f"{key}.json"), output)
+    if sidecar is not None:
+        _atomic_write_json(_words_path(directory, wav), sidecar, compact=True)
+    elif os.path.exists(_words_path(directory, wav)):
+        os.remove(_words_path(directory, wav))  # left by an earlier run
+    _atomic_write_json(json_path, output)
+
+    print(f"Saved transcript → {json_path}")
+
+
+def _load_chunk_audio(audio):
+    if isinstance(audio, str):
+        return whisper.load_audio(audio)
+    # Same scaling as whisper.load_audio
+    return audio.astype(np.float32) / 32768.0
+
+
+def book_language(backend, chunks, cache_dir):
+    """
+    Detect the language once for a whole book from its first 30 s of audio
+    (the first chunks joined), so no chunk pays for its own detection.
+
+    The result is cached like a transcript, under the key of that audio,
+    so a re-run where every chunk hits the cache never loads the model.
+    """
+    head = []
+    n_samples = 0
+    for _, audio in chunks:
+        audio = _load_chunk_audio(audio)[:N_SAMPLES - n_samples]
+        head.append(audio)
+        n_samples += len(audio)
+        if n_samples >= N_SAMPLES:
+            break
+    head = np.concatenate(head)
+
+    key = transcript_cache_key(head, backend.model_name,
+                               {"backend": backend.name,
+                                "detect_language": True})
+    cached = _cache_load(cache_dir, key)
+    if cached is not None:
+        return cached["language"]
+    language = backend.detect_language(head)
+    _atomic_write_json(os.path.join(cache_dir, f"{key}.json"),
+                       {"language": language})
+    return language
+
+
+def _transcribe_batched(backend, directory, chunks, batch_size,
+                        lookup, cache_dir):
+    batch = []
+
+    def flush():
+        print(f"\nTranscribing {', '.join(w for w, _, _ in batch)} ...")
+        results = backend.transcribe_batch([a for _, a, _ in batch])
+        for (wav, _, key), result in zip(batch, results):
+            _write_transcript(directory, wav, result, cache_dir, key)
+        batch.clear()
+
+    for wav, audio in chunks:
+        audio = _load_chunk_audio(audio)
+        key = lookup(wav, audio, batched=True)
+        if key is None:
+            continue
+
+        batch.append((wav, audio, key))
+        if len(batch) == batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+
+# Backend of a transcription worker process
+_worker_backend = None
+
 
-    if not chunk_files:
+def _init_worker(threads, backend):
+    global _worker_backend
+    torch.set_num_threads(threads)
+    _worker_backend = backend
+    backend.model  # load now unless inherited already loaded on fork
+
+
+def _transcribe_in_worker(audio):
+    return _worker_backend.transcribe(audio)
+
+
+def _transcribe_parallel(backend, directory, todo, workers, threads,
+                         cache_dir):
+    """
+    Transcribe todo = [(wav, audio, key)] on a pool of worker processes,
+    each using `threads` intra-op threads. With fork, the parent loads the
+    model once and the workers share its weights copy-on-write; otherwise
+    every worker loads its own replica. Transcripts are written in order.
+    """
+    if "fork" in mp.get_all_start_methods():
+        backend.model
+        ctx = mp.get_context("fork")
+    else:
+        ctx = mp.get_context("spawn")
+
+    print(f"\nTranscribing {len(todo)} chunks with {workers} workers "
+          f"x {threads} threads ...")
+    audios = (_load_chunk_audio(audio) for _, audio, _ in todo)
+    with ctx.Pool(workers, initializer=_init_worker,
+                  initargs=(threads, backend)) as pool:
+        results = pool.imap(_transcribe_in_worker, audios)
+        for (wav, _, key), result in zip(todo, results):
+            _write_transcript(directory, wav, result, cache_dir, key)
+
+
+def transcribe_chunks(directory=".", whisper_model="large", batch_size=1,
+                      cache_dir=None, workers=1, threads_per_worker=None,
+                      backend="whisper", language=None, word_timestamps=False):
+    """
+    Transcribe all *chunk_*.wav files (or the virtual chunks of a manifest)
+    in the directory using Whisper large model, and save JSON files next to them.
+
+    backend picks the engine, see asr_backends: "whisper" (default),
+    "faster-whisper" (int8 CTranslate2 on CPU) or "stub"; an ASRBackend
+    instance can be passed to set its options. whisper_model is the model
+    name given to the backend. Every backend writes the same JSON.
+
+    language is pinned for every chunk: pass a code such as "en", or leave
+    it None to detect it once for the whole book with book_language.
+    With word_timestamps, each chunk also gets a chunk_N.words.json with
+    parallel words/starts/ends/probabilities arrays (see words_sidecar);
+    they are off by default since nothing here uses them and they cost an
+    extra alignment pass per chunk.
+
+    With batch_size > 1, chunks of up to 30 s are transcribed batch_size
+    at a time with transcribe_batch (pack chunks to the Whisper window in
+    split_audio to make the most of it).
+
+    Transcripts are cached in cache_dir (default: CACHE_DIR inside the
+    directory) under transcript_cache_key, so unchanged chunks are not
+    re-transcribed after a re-split or a crash; the model is only loaded
+    if some chunk misses the cache.
+
+    With workers > 1, chunks are transcribed by a pool of model replicas
+    with threads_per_worker intra-op threads each (default: cores split
+    evenly), see _transcribe_parallel. The final throughput line, in
+    audio-seconds per wall-second, is meant for tuning the two.
+    """
+    chunks = list_chunks(directory)
+
+    if not chunks:
         print("No chunk wav files found.")
         return
 
-    print(f"Found {len(chunk_files)} chunks.")
+    print(f"Found {len(chunks)} chunks.")
+
+    if isinstance(backend, str):
+        backend = make_backend(backend, whisper_model,
+                               word_timestamps=word_timestamps)
+    cache_dir = cache_dir or os.path.join(directory, CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    backend.language = language or book_language(backend, chunks, cache_dir)
+    print(f"Language: {backend.language}")
+    stats = {"hits": 0, "misses": 0, "audio_sec": 0.0}
+    t0 = time.perf_counter()
+
+    def lookup(wav, audio, batched=False):
+        """Serve wav from the cache and return None, or return its key."""
+        key = transcript_cache_key(audio, backend.model_name,
+                                   backend.cache_options(batched))
+        cached = _cache_load(cache_dir, key)
+        if cached is None:
+            stats["misses"] += 1
+            stats["audio_sec"] += len(audio) / SAMPLE_RATE
+            return key
+        stats["hits"] += 1
+        cached["chunk_file"] = wav
+        json_path = os.path.join(directory, wav.replace(".wav", ".json"))
+        words = _cache_load(cache_dir, f"{key}.words")
+        if words is not None:
+            _atomic_write_json(_words_path(directory, wav), words,
+                               compact=True)
+        _atomic_write_json(json_path, cached)
+        print(f"Cached transcript → {json_path}")
+        return None
 
-    for wav in sorted(chunk_files):
-        wav_path = os.path.join(directory, wav)
-        json_path = wav_path.replace(".wav", ".json")
+    if workers > 1:
+        # Hash every chunk first; only the misses go to the pool, and their
+        # audio is loaded again lazily so it is never all held in memory.
+        todo = []
+        for wav, audio in chunks:
+            key = lookup(wav, _load_chunk_audio(audio))
+            if key is not None:
+                todo.append((wav, audio, key))
+        if todo:
+            threads = threads_per_worker or max(1, os.cpu_count() // workers)
+            _transcribe_parallel(backend, directory, todo, workers, threads,
+                                 cache_dir)
+    elif batch_size > 1:
+        _transcribe_batched(backend, directory, chunks, batch_size,
+                            lookup, cache_dir)
+    else:
+        for wav, audio in chunks:
+            audio = _load_chunk_audio(audio)
+            key = lookup(wav, audio)
+            if key is None:
+                continue
+
+            print(f"\nTranscribing {wav} ...")
+            result = backend.transcribe(audio)
+            _write_transcript(directory, wav, result, cache_dir, key)
+
+    wall = time.perf_counter() - t0
+    print(f"\nDone! All chunks transcribed. "
+          f"Cache hits: {stats['hits']}, misses: {stats['misses']}.")
+    print(f"Throughput: {stats['audio_sec']:.0f} s of audio in {wall:.1f} s "
+          f"→ {stats['audio_sec'] / wall:.2f} audio-s per wall-s")
+
+
+def stitch_segments(result, chunks_ms):
+    """
+    Cut one long-form result into per-chunk results at chunk boundaries
+    (VAD silence points, [start_ms, end_ms] covering the audio).
+
+    Each word goes to the chunk holding its midpoint, and each segment is
+    split between chunks along with its words, its text rebuilt from the
+    words of each piece, so a chunk's text always matches its words.
+    A segment without words goes whole to the chunk holding its
+    midpoint. Times are made relative to the chunk's start, as if the
+    chunk had been transcribed on its own.
+    """
+    ends = np.array([end_ms for _, end_ms in chunks_ms]) / 1000
+
+    def chunk_of(item):
+        mid = (item["start"] + item["end"]) / 2
+        return min(int(np.searchsorted(ends, mid, side="right")),
+                   len(chunks_ms) - 1)
+
+    # Words to the segment holding their midpoint (else the one before)
+    segments = result.get("segments", [])
+    starts = np.array([seg["start"] for seg in segments])
+    seg_words = [[] for _ in segments]
+    stray = []
+    for word in result.get("words", []):
+        mid = (word["start"] + word["end"]) / 2
+        j = int(np.searchsorted(starts, mid, side="right")) - 1
+        (seg_words[j] if j >= 0 else stray).append(word)
+
+    results = [{"text": "", "language": result.get("language", ""),
+                "segments": [], "words": []} for _ in chunks_ms]
+
+    def add_words(words):
+        for word in words:
+            i = chunk_of(word)
+            offset = chunks_ms[i][0] / 1000
+            results[i]["words"].append(dict(word, start=word["start"] - offset,
+                                            end=word["end"] - offset))
+
+    def add_segment(i, start, end, text):
+        offset = chunks_ms[i][0] / 1000
+        out = results[i]
+        out["segments"].append({
+            "id": len(out["segments"]),
+            "start": round(start - offset, 2),
+            "end": round(end - offset, 2),
+            "text": text,
+        })
+        out["text"] += text
+
+    add_words(stray)
+    for seg, words in zip(segments, seg_words):
+        pieces = {}
+        for word in words:
+            pieces.setdefault(chunk_of(word), []).append(word)
+        if len(pieces) <= 1:
+            i = next(iter(pieces), None)
+            add_segment(chunk_of(seg) if i is None else i,
+                        seg["start"], seg["end"], seg["text"])
+        else:
+            last = len(pieces) - 1
+            for n, (i, piece) in enumerate(sorted(pieces.items())):
+                add_segment(i,
+                            seg["start"] if n == 0 else piece[0]["start"],
+                            seg["end"] if n == last else piece[-1]["end"],
+                            "".join(w["word"] for w in piece))
+        add_words(words)
+    return results
+
+
+def transcribe_longform(path, whisper_model="large", silence_ms=1000,
+                        frame_ms=30, vad_mode=3, min_chunk_sec=5.0,
+                        max_chunk_sec=MAX_CHUNK_SEC, backend="whisper",
+                        language=None, word_timestamps=False,
+                        block_sec=10.0):
+    """
+    Transcribe a whole chapter straight from its MP3, without splitting
+    it into chunk WAVs first.
+
+    The file is decoded once: the same PCM stream feeds the VAD, which
+    finds chunk boundaries exactly like split_audio_on_silence_streaming
+    (silence_ms ... max_chunk_sec), and is then transcribed in one pass.
+    Whisper's long-form decoding slides a 30 s window along the audio and
+    conditions each window on the previous text, so no context is lost at
+    chunk boundaries. The result is stitched back into the chunks with
+    stitch_segments and written as the usual chunk_N.json files (plus
+    words sidecars with word_timestamps) in <name>_chunks.
+
+    The chunks folder also gets the virtual-chunk PCM file and manifest,
+    so the chunks can still be listed, exported or re-transcribed.
+    """
+    # The same marker split_audio_batch writes, so it skips this chapter
+    params = effective_params(split_audio_on_silence_streaming, {
+        "silence_ms": silence_ms, "frame_ms": frame_ms, "vad_mode": vad_mode,
+        "min_chunk_sec": min_chunk_sec, "max_chunk_sec": max_chunk_sec,
+        "virtual": True})
+    base = os.path.splitext(path)[0] + "_chunks"
+    os.makedirs(base, exist_ok=True)
+    t0 = time.perf_counter()
 
-        print(f"\nTranscribing {wav} ...")
+    pcm = bytearray()
 
-        # Run Whisper transcription
-        result = model.transcribe(
-            wav_path,
-            fp16=False,            # CPU users need this; GPU users can remove it
-            word_timestamps=True   # include detailed timestamps
-        )
+    def tee(blocks):
+        with open(os.path.join(base, PCM_FILE), "wb") as pcm_out:
+            for block in blocks:
+                pcm.extend(block)
+                pcm_out.write(block)
+                yield block
 
-        # Prepare JSON structure
-        output = {
-            "chunk_file": wav,
-            "text": result.get("text", ""),
-            "language": result.get("language", ""),
-            "segments": [
-                {
-                    "id": seg.get("id"),
-                    "start": seg.get("start"),
-                    "end": seg.get("end"),
-                    "text": seg.get("text")
-                }
-                for seg in result.get("segments", [])
-            ]
-        }
+    segments = stream_segments_ms(
+        tee(iter_pcm_blocks(path, block_sec)),
+        silence_ms=silence_ms,
+        frame_ms=frame_ms,
+        vad_mode=vad_mode,
+        max_segment_ms=int(max_chunk_sec * 1000))
+    chunks_ms = merge_short_segments(list(segments),
+                                     min_chunk_sec=min_chunk_sec,
+                                     max_chunk_sec=max_chunk_sec,
+                                     pcm=pcm, frame_ms=frame_ms)
+    write_manifest(base, chunks_ms)
+    remove_stale_chunks(base, len(chunks_ms), virtual=True)
+    write_split_marker(base, path, chunks_ms, params)
+    audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    del pcm
+    t_split = time.perf_counter() - t0
+    print(f"Decoded {len(audio) / SAMPLE_RATE:.0f} s into "
+          f"{len(chunks_ms)} chunks in {t_split:.1f} s.")
 
-        # Save JSON next to the chunk file
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(output, f, ensure_ascii=False, indent=2)
+    if isinstance(backend, str):
+        backend = make_backend(backend, whisper_model,
+                               word_timestamps=word_timestamps)
+    backend.language = language or backend.detect_language(audio[:N_SAMPLES])
+    print(f"Language: {backend.language}")
 
-        print(f"Saved transcript → {json_path}")
+    print(f"\nTranscribing {path} ...")
+    result = backend.transcribe(audio)
+    for i, chunk_result in enumerate(stitch_segments(result, chunks_ms),
+                                     start=1):
+        _write_transcript(base, f"chunk_{i}.wav", chunk_result)
 
-    print("\nDone! All chunks transcribed.")
+    wall = time.perf_counter() - t0
+    print(f"\nDone! {len(chunks_ms)} chunks transcribed.")
+    print(f"Throughput: {len(audio) / SAMPLE_RATE:.0f} s of audio in "
+          f"{wall:.1f} s → {len(audio) / SAMPLE_RATE / wall:.2f} audio-s "
+          f"per wall-s")
+    return base
 
 
 if __name__ == "__main__":
-    transcribe_chunks("/home/bo/workspace/whisper/tasks/sample_chunks")
\ No newline at end of file
+    transcribe_chunks("/home/bo/workspace/whisper/tasks/sample_chunks")
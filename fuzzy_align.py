@@ -0,0 +1,559 @@
+import os
+import re
+import json
+import glob
+import time
+from collections import Counter
+
+import numpy as np
+
+
+# ===========================================
+# Normalization
+# ===========================================
+# Whisper writes British spellings and "Mr", the book American ones and "Mr."
+SPELLING_VARIANTS = {
+    "moustache": "mustache",
+    "moustaches": "mustaches",
+    "rumours": "rumors",
+    "rumour": "rumor",
+    "neighbours": "neighbors",
+    "neighbour": "neighbor",
+    "colour": "color",
+    "colours": "colors",
+    "favourite": "favorite",
+    "honour": "honor",
+    "grey": "gray",
+    "pyjamas": "pajamas",
+    "okay": "ok",
+}
+
+_QUOTES = str.maketrans({
+    "’": "'", "‘": "'", "“": '"', "”": '"', "—": " ", "–": " ", "…": " ",
+})
+_WORD = re.compile(r"\w+(?:'\w+)*")
+
+
+def normalize_token(token):
+    token = token.lower().replace("'", "")
+    return SPELLING_VARIANTS.get(token, token)
+
+
+def tokenize_with_offsets(text):
+    """
+    Split text into normalized word tokens and return (tokens, spans), with
+    spans[i] = (start, end) the character offsets of tokens[i] in text.
+    Punctuation, quotes and dashes are dropped, so "Mr." == "Mr" and
+    "half-past" == "half past".
+    """
+    tokens, spans = [], []
+    for m in _WORD.finditer(text.translate(_QUOTES)):
+        tokens.append(normalize_token(m.group()))
+        spans.append(m.span())
+    return tokens, spans
+
+
+def normalize_text(text):
+    return " ".join(tokenize_with_offsets(text)[0])
+
+
+# ===========================================
+# Anchoring + banded edit distance
+# ===========================================
+def anchor_offset(source, target, n=3):
+    """
+    Estimate where source starts in target (a token index) from the shared
+    n-grams: every match votes for target_pos - source_pos, and the most
+    voted offset wins. None if no n-gram is shared.
+    """
+    index = {}
+    for j in range(len(target) - n + 1):
+        index.setdefault(tuple(target[j: j + n]), []).append(j)
+
+    votes = Counter()
+    for i in range(len(source) - n + 1):
+        for j in index.get(tuple(source[i: i + n]), ()):
+            votes[j - i] += 1
+    if not votes:
+        return None
+    return votes.most_common(1)[0][0]
+
+
+def _edit_rows(source, target, free_start):
+    """
+    Last row of the token edit distance DP of source against target, and
+    for every column the target index where its best path started.
+    With free_start, skipping leading target tokens costs nothing.
+
+    Rows are vectorized: the insertion chain D[i][j] = D[i][j-1] + 1 is a
+    running minimum of D'[k] - k, so each row is a few numpy passes.
+    """
+    n = len(target)
+    cols = np.arange(n + 1)
+    tgt = np.array(target, dtype=object)
+    prev = np.zeros(n + 1, dtype=np.int64) if free_start else cols.copy()
+    starts = cols.copy() if free_start else np.zeros(n + 1, dtype=np.int64)
+    never = np.iinfo(np.int64).max // 2
+
+    for i, tok in enumerate(source, start=1):
+        # substitution/match (from j-1) or skipping a source token (from j)
+        diag = np.full(n + 1, never)
+        diag[1:] = prev[:-1] + (tgt != tok)
+        up = prev + 1
+        cand = np.minimum(diag, up)
+        cand_start = np.where(diag <= up, np.r_[0, starts[:-1]], starts)
+
+        # insertions of target tokens within the row
+        vals = cand - cols
+        run = np.minimum.accumulate(vals)
+        best = np.maximum.accumulate(np.where(vals == run, cols, 0))
+        prev = run + cols
+        starts = cand_start[best]
+    return prev, starts
+
+
+def best_substring(source, target):
+    """
+    Semi-global edit distance: the substring target[s:e] closest to the
+    whole of source, with free leading and trailing target tokens.
+    Returns (distance, s, e).
+    """
+    dist, starts = _edit_rows(source, target, free_start=True)
+    e = int(np.argmin(dist))
+    return int(dist[e]), int(starts[e]), e
+
+
+def _extend_span(text, lo, hi):
+    # Take the opening quote before the first word and the punctuation
+    # and closing quotes after the last one, as they belong to the span
+    while lo > 0 and text[lo - 1] in "\"'“‘(":
+        lo -= 1
+    while hi < len(text) and not text[hi].isspace() and not text[hi].isalnum():
+        hi += 1
+    return lo, hi
+
+
+def align_span(source_text, reference, band=None, n=3):
+    """
+    Find the verbatim substring of reference that best matches source_text.
+
+    The reference is tokenized with normalized spelling and punctuation,
+    the source is anchored by its shared n-grams (anchor_offset), and the
+    best substring is found with edit distance inside a band of tokens
+    around the anchor (default: a quarter of the source length). Without
+    any anchor the whole reference is searched.
+
+    Returns {"target", "start", "end", "score"}: the target copied from
+    the reference, its character span, and score = 1 - distance / length
+    in [0, 1], where 1 means identical after normalization.
+    """
+    source, _ = tokenize_with_offsets(source_text)
+    target, spans = tokenize_with_offsets(reference)
+    if not source or not target:
+        return {"target": "", "start": 0, "end": 0, "score": 0.0}
+
+    band = band if band is not None else max(10, len(source) // 4)
+    offset = anchor_offset(source, target, n=n)
+    lo, hi = 0, len(target)
+    if offset is not None:
+        lo = max(0, offset - band)
+        hi = min(len(target), offset + len(source) + band)
+
+    dist, s, e = best_substring(source, target[lo:hi])
+    s, e = s + lo, e + lo
+    if e <= s:
+        return {"target": "", "start": 0, "end": 0, "score": 0.0}
+
+    start, end = _extend_span(reference, spans[s][0], spans[e - 1][1])
+    return {
+        "target": reference[start:end],
+        "start": start,
+        "end": end,
+        "score": 1 - dist / max(len(source), e - s),
+    }
+
+
+def token_similarity(a, b):
+    """1 - normalized token edit distance between two texts."""
+    a, _ = tokenize_with_offsets(a)
+    b, _ = tokenize_with_offsets(b)
+    if not a and not b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    dist, _ = _edit_rows(a, b, free_start=False)
+    return 1 - dist[-1] / max(len(a), len(b))
+
+
+# ===========================================
+# Whole-chapter alignment
+# ===========================================
+def _window(row, a, b, fill):
+    # Values of a banded row (lo, vals) over columns [a, b), fill outside
+    lo, vals = row
+    out = np.full(b - a, fill)
+    s, e = max(a, lo), min(b, lo + len(vals))
+    if s < e:
+        out[s - a: e - a] = vals[s - lo: e - lo]
+    return out
+
+
+def _banded_rows(source, target, band, keep):
+    """
+    Semi-global edit distance of two int token arrays, restricted to
+    columns within band of the diagonal. Rows are stored as their band
+    only, (first column, values), so time and memory are O(n * band);
+    returns {i: row i} for the rows in keep (outside the band: inf).
+    """
+    n, m = len(source), len(target)
+    inf = np.int64(1) << 40
+
+    def columns(i):
+        center = i * m // max(n, 1)
+        return max(0, center - band), min(m + 1, center + band + 1)
+
+    lo, hi = columns(0)
+    prev = (lo, np.zeros(hi - lo, dtype=np.int64))  # free leading target tokens
+    rows = {0: prev} if 0 in keep else {}
+
+    for i in range(1, n + 1):
+        lo, hi = columns(i)
+        # skipping source token i (from above) or matching it (diagonal)
+        cand = _window(prev, lo, hi, inf) + 1
+        d_lo = max(lo, 1)
+        diag = (_window(prev, d_lo - 1, hi - 1, inf)
+                + (target[d_lo - 1: hi - 1] != source[i - 1]))
+        cand[d_lo - lo:] = np.minimum(cand[d_lo - lo:], diag)
+        # skipping target tokens within the row: running min of cand - j
+        cols = np.arange(lo, hi)
+        prev = (lo, np.minimum.accumulate(cand - cols) + cols)
+        if i in keep:
+            rows[i] = prev
+    return rows
+
+
+def project_boundaries(source, target, boundaries, band=None):
+    """
+    Globally align the source tokens to the target tokens and return, for
+    every source boundary index (0 ... len(source)), the target index the
+    optimal alignment passes through there.
+
+    Hirschberg's idea, applied to all boundaries at once: a forward and a
+    backward banded pass keep only the DP rows at the boundaries (linear
+    memory), and at each boundary the crossing column is the argmin of
+    forward + backward cost.
+    """
+    vocab = {}
+    src = np.array([vocab.setdefault(t, len(vocab)) for t in source], dtype=np.int64)
+    tgt = np.array([vocab.setdefault(t, len(vocab)) for t in target], dtype=np.int64)
+    n, m = len(src), len(tgt)
+    if band is None:
+        band = max(200, abs(m - n) + m // 10)
+
+    forward = _banded_rows(src, tgt, band, set(boundaries))
+    backward = _banded_rows(src[::-1], tgt[::-1], band,
+                            {n - i for i in boundaries})
+    cols = []
+    for i in boundaries:
+        f_lo, f_vals = forward[i]
+        b_lo, b_vals = backward[n - i]
+        # The backward row, flipped back to forward column numbers
+        b_row = (m + 1 - b_lo - len(b_vals), b_vals[::-1])
+        lo = min(f_lo, b_row[0])
+        hi = max(f_lo + len(f_vals), b_row[0] + len(b_vals))
+        total = (_window(forward[i], lo, hi, np.int64(1) << 40)
+                 + _window(b_row, lo, hi, np.int64(1) << 40))
+        cols.append(lo + int(np.argmin(total)))
+    return np.maximum.accumulate(cols).tolist()
+
+
+def align_chapter(sources, reference, band=None):
+    """
+    Align a chapter's transcripts, in chunk order, against the whole
+    chapter text in one global pass.
+
+    Returns one {"target", "start", "end"} per source. The targets are
+    contiguous, non-overlapping slices of reference in order: each cut
+    falls between two words (after any punctuation of the first), where
+    the global alignment crosses the boundary between two transcripts.
+    A transcript with no counterpart in the text gets an empty target.
+    """
+    tokens, bounds = [], [0]
+    for text in sources:
+        tokens += tokenize_with_offsets(text)[0]
+        bounds.append(len(tokens))
+    target, spans = tokenize_with_offsets(reference)
+    cols = project_boundaries(tokens, target, bounds, band=band)
+
+    def cut(j):
+        # Character offset between target tokens j - 1 and j
+        if j == 0:
+            return spans[0][0] if spans else 0
+        return _extend_span(reference, spans[j - 1][0], spans[j - 1][1])[1]
+
+    results = []
+    for k in range(len(sources)):
+        start, end = cut(cols[k]), cut(cols[k + 1])
+        if cols[k] == 0 and spans:
+            start = _extend_span(reference, spans[0][0], spans[0][1])[0]
+        # Trim the spaces between sentences, keeping the spans disjoint
+        text = reference[start:end]
+        start += len(text) - len(text.lstrip())
+        end -= len(text) - len(text.rstrip())
+        end = max(start, end)
+        results.append({"target": reference[start:end], "start": start,
+                        "end": end})
+    return results
+
+
+def align_chapter_folder(chunks_folder, reference_file, write=False):
+    """
+    align_chapter over the chunk_N.json transcripts of chunks_folder, in
+    chunk order, against reference_file. Returns {"chunk_file", "source",
+    "target"} per chunk; with write=True they are also saved as
+    chunk_N_aligned.json.
+    """
+    paths = sorted(
+        (p for p in glob.glob(os.path.join(chunks_folder, "chunk_*.json"))
+         if re.fullmatch(r"chunk_\d+\.json", os.path.basename(p))),
+        key=lambda p: int(re.findall(r"\d+", os.path.basename(p))[0]),
+    )
+    chunks = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            chunks.append(json.load(f))
+    with open(reference_file, "r", encoding="utf-8") as f:
+        reference = f.read()
+
+    spans = align_chapter([c["text"] for c in chunks], reference)
+    results = []
+    for path, chunk, span in zip(paths, chunks, spans):
+        res = {"chunk_file": chunk["chunk_file"], "source": chunk["text"],
+               "target": span["target"]}
+        results.append(res)
+        if write:
+            with open(path.replace(".json", "_aligned.json"), "w",
+                      encoding="utf-8") as f:
+                json.dump(res, f, ensure_ascii=False, indent=2)
+    return results
+
+
+# ===========================================
+# Numbered sentences for span output
+# ===========================================
+# A sentence ends at . ! ? … (or their full-width forms) plus any closing
+# quotes, and at every line break
+_SENTENCE_END = re.compile(r"[.!?。！？…]+[”’\"'」』)]*")
+_ABBREVIATIONS = ("Mr.", "Mrs.", "Ms.", "Dr.", "St.", "Prof.", "No.")
+
+
+def split_sentences(text):
+    """Character spans (start, end) of the sentences of text, in order."""
+    spans = []
+    for line in re.finditer(r"[^\n]+", text):
+        start = line.start()
+        for m in _SENTENCE_END.finditer(line.group()):
+            end = line.start() + m.end()
+            if text.endswith(_ABBREVIATIONS, 0, end):
+                continue
+            if text[start:end].strip():
+                spans.append((start, end))
+            start = end
+        if text[start: line.end()].strip():
+            spans.append((start, line.end()))
+    # Trim surrounding spaces, so every span starts and ends on text
+    return [(s + len(text[s:e]) - len(text[s:e].lstrip()),
+             e - len(text[s:e]) + len(text[s:e].rstrip()))
+            for s, e in spans]
+
+
+def number_sentences(text):
+    """
+    Return (numbered, spans): text with one sentence per line prefixed by
+    [1], [2], ..., and the character span of each numbered sentence.
+    """
+    spans = split_sentences(text)
+    numbered = "\n".join(f"[{i}] {text[s:e]}"
+                         for i, (s, e) in enumerate(spans, start=1))
+    return numbered, spans
+
+
+_SPAN_OUTPUT = re.compile(r"start\W*(\d+).*?end\W*(\d+)", re.S)
+
+
+def parse_span(output):
+    """(start, end) sentence numbers of a {"start": i, "end": j} output."""
+    m = _SPAN_OUTPUT.search(output)
+    if m is None:
+        raise ValueError(f"No start/end markers in output: {output!r}")
+    return int(m.group(1)), int(m.group(2))
+
+
+def slice_span(text, spans, start, end):
+    """The verbatim text from sentence start to sentence end (1-based)."""
+    if not 1 <= start <= end <= len(spans):
+        raise ValueError(f"Invalid sentence span {start}-{end} "
+                         f"of {len(spans)} sentences.")
+    return text[spans[start - 1][0]: spans[end - 1][1]]
+
+
+# ===========================================
+# Verification
+# ===========================================
+# verify_span scores at or above VERIFY_ACCEPT are aligned, at or below
+# VERIFY_REJECT misaligned; the band in between goes to the LLM judge.
+# Tuned on ch1 with evaluate_verifier.
+VERIFY_ACCEPT = 0.85
+VERIFY_REJECT = 0.5
+
+
+def _ends_match(source, target, n):
+    # The first/last n-gram of source within n tokens of the target's ends
+    n = min(n, len(source), len(target))
+    m = len(target)
+    head = any(source[:n] == target[j: j + n] for j in range(n + 1))
+    tail = any(source[-n:] == target[m - n - j: m - j] for j in range(n + 1))
+    return head, tail
+
+
+def verify_span(source_text, target_text, n=3):
+    """
+    Judge whether target_text holds the same words as source_text, from
+    their normalized token edit distance, their length ratio and whether
+    the first and last n-grams match. Returns {"score", "reason"}, with
+    score in [0, 1] (see VERIFY_ACCEPT and VERIFY_REJECT).
+    """
+    source, _ = tokenize_with_offsets(source_text)
+    target, _ = tokenize_with_offsets(target_text)
+    if not source or not target:
+        return {"score": 0.0, "reason": "empty source or target"}
+
+    dist, _ = _edit_rows(source, target, free_start=False)
+    similarity = 1 - dist[-1] / max(len(source), len(target))
+    ratio = len(target) / len(source)
+    head, tail = _ends_match(source, target, n)
+
+    score = similarity - 0.15 * (not head) - 0.15 * (not tail) \
+        - 0.5 * abs(np.log(ratio))
+    reasons = [f"token similarity {similarity:.2f}",
+               f"length ratio {ratio:.2f}"]
+    if not head:
+        reasons.append("beginnings differ")
+    if not tail:
+        reasons.append("endings differ")
+    return {"score": float(max(0.0, score)), "reason": ", ".join(reasons)}
+
+
+def verify_decision(score):
+    """True, False, or None when the score is in the uncertain band."""
+    if score >= VERIFY_ACCEPT:
+        return True
+    if score <= VERIFY_REJECT:
+        return False
+    return None
+
+
+# ===========================================
+# Agreement with the LLM-aligned chunks
+# ===========================================
+def evaluate_against_golden(chunks_folder, reference_file, threshold=0.8):
+    """
+    Run align_span on every chunk_*_aligned.json in chunks_folder against
+    the whole chapter and compare with the stored LLM targets. Prints the
+    share of chunks above the confidence threshold and how closely their
+    targets agree with the LLM ones.
+    """
+    with open(reference_file, "r", encoding="utf-8") as f:
+        reference = f.read()
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(chunks_folder, "chunk_*_aligned.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            golden = json.load(f)
+        res = align_span(golden["source"], reference)
+        rows.append((os.path.basename(path), res["score"],
+                     token_similarity(res["target"], golden["target"])))
+
+    confident = [r for r in rows if r[1] >= threshold]
+    agree = [r for r in confident if r[2] >= 0.9]
+    print(f"{len(confident)}/{len(rows)} chunks at confidence >= {threshold}")
+    print(f"{len(agree)}/{len(confident)} of them agree with the LLM target "
+          f"(token similarity >= 0.9), mean similarity "
+          f"{np.mean([r[2] for r in confident]):.3f}")
+    for name, score, sim in rows:
+        if score < threshold or sim < 0.9:
+            print(f"  {name}: confidence {score:.2f}, similarity {sim:.2f}")
+    return rows
+
+
+def chunk_index(path):
+    return int(re.search(r"chunk_(\d+)", os.path.basename(path)).group(1))
+
+
+def evaluate_verifier(chunks_folder):
+    """
+    Band the chunk_*_aligned.json pairs of chunks_folder with verify_span,
+    along with misaligned pairs made from them: the target without its
+    first or last sentence, and the next chunk's target.
+    """
+    pairs = []
+    # In chunk order, so "the next chunk" is the neighbouring one
+    for path in sorted(glob.glob(os.path.join(chunks_folder, "chunk_*_aligned.json")),
+                       key=chunk_index):
+        with open(path, "r", encoding="utf-8") as f:
+            pairs.append(json.load(f))
+
+    negatives = []
+    for i, pair in enumerate(pairs):
+        sentences = pair["target"].split(". ")
+        if len(sentences) > 1:
+            negatives.append((pair["source"], ". ".join(sentences[:-1])))
+            negatives.append((pair["source"], ". ".join(sentences[1:])))
+        if i + 1 < len(pairs):
+            negatives.append((pair["source"], pairs[i + 1]["target"]))
+
+    for name, cases in (("aligned", [(p["source"], p["target"]) for p in pairs]),
+                        ("misaligned", negatives)):
+        decisions = Counter(verify_decision(verify_span(s, t)["score"])
+                            for s, t in cases)
+        print(f"{name}: {decisions[True]} accepted, {decisions[False]} "
+              f"rejected, {decisions[None]} to the LLM, of {len(cases)}")
+
+
+def evaluate_chapter_alignment(chunks_folder, reference_file):
+    """
+    Time align_chapter_folder on a chapter and compare its targets with
+    the stored LLM targets of chunks_folder.
+    """
+    t0 = time.perf_counter()
+    results = align_chapter_folder(chunks_folder, reference_file)
+    elapsed = time.perf_counter() - t0
+
+    sims = []
+    for res in results:
+        path = os.path.join(chunks_folder, res["chunk_file"].replace(
+            ".wav", "_aligned.json"))
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            golden = json.load(f)
+        sims.append((res["chunk_file"],
+                     token_similarity(res["target"], golden["target"])))
+    print(f"Aligned {len(results)} chunks in one pass in {elapsed:.2f} s")
+    print(f"{sum(s >= 0.9 for _, s in sims)}/{len(sims)} agree with the LLM "
+          f"target (token similarity >= 0.9), mean similarity "
+          f"{np.mean([s for _, s in sims]):.3f}")
+    for name, sim in sims:
+        if sim < 0.9:
+            print(f"  {name}: similarity {sim:.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    evaluate_against_golden(
+        "data/HP1/audio_en/ch1_chunks", "data/HP1/text_en/1/ch1.txt"
+    )
+    evaluate_verifier("data/HP1/audio_en/ch1_chunks")
+    evaluate_chapter_alignment(
+        "data/HP1/audio_en/ch1_chunks", "data/HP1/text_en/1/ch1.txt"
+    )
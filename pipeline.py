@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+# Put through the queues after the last item, to stop the workers
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline: fn(item) -> item for the next stage, or None
+    to drop it; an item whose fn raises is reported and dropped too, so
+    one bad item never stalls the pipeline. fn is blocking (model
+    inference, file I/O) and runs in a worker thread, so the other stages
+    keep going meanwhile. With one worker (the default) items stay in
+    order.
+    """
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0  # seconds in fn
+        self.starved = 0.0  # seconds waiting for input
+        self.blocked = 0.0  # seconds waiting for room downstream
+        self.depths = []  # input queue depth at every take
+        self.finished = 0  # workers that have stopped
+
+    def report(self, wall):
+        depth = sum(self.depths) / len(self.depths) if self.depths else 0.0
+        return (f"{self.name:>10} {self.items:6d} "
+                f"{self.busy / (wall * self.workers):7.0%} "
+                f"{self.starved / (wall * self.workers):8.0%} "
+                f"{self.blocked / (wall * self.workers):8.0%} "
+                f"{depth:6.1f} {max(self.depths, default=0):5d}")
+
+
+class Pipeline:
+    """
+    Stages connected by bounded asyncio queues of queue_size items, so a
+    fast stage runs at most queue_size items ahead of a slow one.
+
+    Utilization per stage (share of the wall time in fn), with the time
+    spent starved for input or blocked on a full output queue and the
+    input queue depth, is printed every report_every seconds and at the
+    end: the bottleneck is the busy stage whose input queue stays full.
+    """
+
+    def __init__(self, stages, queue_size=4, report_every=30.0):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.t0 = None
+
+    def run(self, items):
+        """Push items through all stages; returns the last stage's outputs."""
+        return asyncio.run(self.run_async(items))
+
+    async def run_async(self, items):
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        results = []
+        self.t0 = time.perf_counter()
+        workers = [
+            asyncio.create_task(self._worker(stage, queues, i, results))
+            for i, stage in enumerate(self.stages)
+            for _ in range(stage.workers)
+        ]
+        reporter = asyncio.create_task(self._report_periodically())
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            await queues[0].put(_DONE)
+        await asyncio.gather(*workers)
+        reporter.cancel()
+        self.report()
+        return results
+
+    async def _worker(self, stage, queues, i, results):
+        inbox = queues[i]
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        while True:
+            t = time.perf_counter()
+            stage.depths.append(inbox.qsize())
+            item = await inbox.get()
+            stage.starved += time.perf_counter() - t
+            if item is _DONE:
+                break
+            t = time.perf_counter()
+            try:
+                out = await asyncio.to_thread(stage.fn, item)
+            except Exception as e:
+                print(f"Error in {stage.name}: {e!r}")
+                out = None
+            stage.busy += time.perf_counter() - t
+            stage.items += 1
+            if out is None:
+                continue
+            if outbox is None:
+                results.append(out)
+                continue
+            t = time.perf_counter()
+            await outbox.put(out)
+            stage.blocked += time.perf_counter() - t
+        # The last worker of a stage to finish stops the next stage
+        stage.finished += 1
+        if outbox is not None and stage.finished == stage.workers:
+            for _ in range(self.stages[i + 1].workers):
+                await outbox.put(_DONE)
+
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(self.report_every)
+            self.report()
+
+    def report(self):
+        wall = time.perf_counter() - self.t0
+        print(f"Pipeline after {wall:.1f} s:")
+        print(f"{'stage':>10} {'items':>6} {'busy':>7} {'starved':>8} "
+              f"{'blocked':>8} {'depth':>6} {'max':>5}")
+        for stage in self.stages:
+            print(stage.report(wall))